@@ -0,0 +1,174 @@
+"""
+Online archival of old orders: moves orders created before a cutoff, and
+their lines, from "order" / order_product into order_archive /
+order_product_archive in small batches, while the application keeps running.
+
+    with get_session() as session:
+        report = archive_orders(session, cutoff=datetime(2024, 1, 1))
+
+Each batch is one short transaction:
+
+1. the next batch_size old orders (keyset on id) are locked with
+   FOR UPDATE SKIP LOCKED, so orders someone is working on are skipped and
+   nobody can add a line to a locked order (the FK check needs a lock on it);
+2. one statement copies the orders (with their total) into order_archive,
+   moves their lines with DELETE ... RETURNING feeding an INSERT, and
+   deletes the orders, which the RESTRICT foreign key of order_product
+   allows because the lines are gone by the end of the statement.
+
+Between batches the job sleeps while replicas lag behind or the server is
+busy. PostgreSQL only.
+"""
+
+import time
+
+from sqlalchemy import select, text
+
+from models import Order
+
+# One statement per batch. All its parts see the rows as they were before
+# it started, so the orders (with their total) are read before the lines are
+# deleted, and the RESTRICT check on "order" only runs at the end of the
+# statement, when the lines are gone. order_total_trigger fires for the
+# deleted lines afterwards too, but the orders are gone by then: its UPDATE
+# matches nothing and writes no new order row versions.
+archive_batch_sql = text("""
+WITH orders AS (
+    SELECT id, user_id, created_at, updated_at, total
+    FROM "order"
+    WHERE id = ANY(:ids)
+),
+archived_orders AS (
+    INSERT INTO order_archive (id, user_id, created_at, updated_at, total)
+    SELECT id, user_id, created_at, updated_at, total FROM orders
+    RETURNING id
+),
+lines AS (
+    DELETE FROM order_product
+    WHERE order_id = ANY(:ids)
+    RETURNING order_id, product_id, quantity, unit_price
+),
+archived_lines AS (
+    INSERT INTO order_product_archive (order_id, product_id, quantity, unit_price)
+    SELECT order_id, product_id, quantity, unit_price FROM lines
+    RETURNING order_id
+),
+deleted_orders AS (
+    DELETE FROM "order"
+    WHERE id IN (SELECT id FROM orders)
+)
+SELECT
+    (SELECT count(*) FROM archived_orders) AS orders,
+    (SELECT count(*) FROM archived_lines) AS lines
+""")
+
+
+class ArchiveReport:
+    def __init__(self):
+        self.orders = 0
+        self.lines = 0
+        self.batches = 0
+        # seconds spent waiting for replicas / load to go down
+        self.throttled = 0.0
+
+    def __repr__(self):
+        return (
+            f"ArchiveReport(orders={self.orders}, lines={self.lines}, "
+            f"batches={self.batches}, throttled={self.throttled:.1f}s)"
+        )
+
+
+def replication_lag(session):
+    """
+    Seconds the slowest replica is behind on replaying (0 without replicas).
+    """
+    lag = session.execute(
+        text("SELECT extract(epoch FROM max(replay_lag)) FROM pg_stat_replication")
+    ).scalar()
+    return float(lag or 0)
+
+
+def active_connections(session):
+    """
+    Number of other connections currently running a statement.
+    """
+    return session.execute(
+        text(
+            "SELECT count(*) FROM pg_stat_activity "
+            "WHERE state = 'active' AND pid <> pg_backend_pid()"
+        )
+    ).scalar()
+
+
+def wait_for_capacity(
+    session, max_replication_lag=5.0, max_active=None, poll_interval=1.0, timeout=600
+):
+    """
+    Blocks while a replica lags more than max_replication_lag seconds or more
+    than max_active connections are busy. Returns the seconds waited.
+    """
+    waited = 0.0
+    while True:
+        lag = replication_lag(session)
+        busy = active_connections(session) if max_active is not None else 0
+        session.commit()
+        if lag <= max_replication_lag and (max_active is None or busy <= max_active):
+            return waited
+        if waited >= timeout:
+            raise TimeoutError(
+                f"still throttled after {waited:.0f}s (lag {lag:.1f}s, {busy} active)"
+            )
+        time.sleep(poll_interval)
+        waited += poll_interval
+
+
+def archive_orders(
+    session,
+    cutoff,
+    batch_size=500,
+    pause=0.1,
+    max_replication_lag=5.0,
+    max_active=None,
+    max_batches=None,
+):
+    """
+    Moves orders created before cutoff (and their lines) to the archive
+    tables, batch_size orders per transaction. Returns an ArchiveReport.
+
+    Orders locked by someone else at that moment are skipped; they are picked
+    up by the next run. pause is the sleep between batches, max_batches
+    stops the run early (e.g. to spread it over several nights).
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        raise ValueError("archive_orders needs PostgreSQL")
+
+    report = ArchiveReport()
+    last_id = 0
+    while max_batches is None or report.batches < max_batches:
+        try:
+            ids = session.scalars(
+                select(Order.id)
+                .where(Order.id > last_id, Order.created_at < cutoff)
+                .order_by(Order.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not ids:
+                session.commit()
+                break
+            orders, lines = session.execute(archive_batch_sql, {"ids": ids}).one()
+            report.orders += orders
+            report.lines += lines
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            print(f"Error: archiving orders after id {last_id} failed: {e}")
+            raise
+
+        report.batches += 1
+        last_id = ids[-1]
+        time.sleep(pause)
+        report.throttled += wait_for_capacity(
+            session, max_replication_lag=max_replication_lag, max_active=max_active
+        )
+    return report
@@ -0,0 +1,158 @@
+import json
+import random
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import event
+
+from db import get_engine
+from sql_normalize import normalize_sql
+
+EXPLAIN_PREFIX = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+ESTIMATE_PREFIX = "EXPLAIN (FORMAT JSON) "
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+
+class AutoExplain:
+    """
+    Captures the plan of slow statements on an engine (PostgreSQL only).
+
+        explain = AutoExplain(threshold_ms=200, sample_rate=0.001).install()
+        ...
+        for plan in explain.plans:
+            print(plan["duration_ms"], plan["sql"], plan["seq_scans"])
+
+    A statement is explained when it took longer than threshold_ms, or at
+    random for a sample_rate fraction of all statements. It is run a second
+    time as EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) inside a SAVEPOINT that is
+    rolled back afterwards, so an explained INSERT/UPDATE/DELETE changes
+    nothing and a failing EXPLAIN doesn't break the caller's transaction.
+    On autocommit connections there is no transaction to protect the data,
+    so data-modifying statements only get an estimated plan (no ANALYZE).
+
+    Explaining re-runs the statement, which is why this is opt-in and meant
+    for thresholds well above the typical query time.
+    Plans are kept in memory (the last max_plans) and, with log_path, appended
+    to a JSON-lines file. Sequential scans on tables with more than
+    seq_scan_rows rows are listed in "seq_scans".
+    """
+
+    def __init__(
+        self,
+        engine=None,
+        threshold_ms=500,
+        sample_rate=0.0,
+        max_plans=500,
+        seq_scan_rows=10_000,
+        log_path=None,
+    ):
+        self.engine = engine if engine is not None else get_engine()
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.seq_scan_rows = seq_scan_rows
+        self.log_path = log_path
+        self.plans = deque(maxlen=max_plans)
+
+        self._table_rows = {}
+        self._log_lock = threading.Lock()
+
+    def install(self):
+        if self.engine.dialect.name != "postgresql":
+            raise ValueError("AutoExplain needs a PostgreSQL engine")
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        return self
+
+    def remove(self):
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+
+    def _before_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        if context is not None:
+            context._auto_explain_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_auto_explain_start", None)
+        if start is None or executemany:
+            return
+        elapsed = time.perf_counter() - start
+        if elapsed < self.threshold and random.random() >= self.sample_rate:
+            return
+        if not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return
+
+        try:
+            plan = self._explain(cursor.connection, statement, parameters)
+            seq_scans = self._large_seq_scans(cursor.connection, plan["Plan"])
+        except Exception as e:
+            print(f"Error: could not explain statement: {e}")
+            return
+        self._record(statement, elapsed, plan, seq_scans)
+
+    def _run_isolated(self, dbapi_connection, sql, parameters=None):
+        # A raw DBAPI cursor, going through SQLAlchemy would fire our own events.
+        # Inside a transaction, run in a SAVEPOINT that is always rolled back:
+        # explained DML leaves no trace and an error doesn't abort the
+        # caller's transaction.
+        with dbapi_connection.cursor() as cursor:
+            if getattr(dbapi_connection, "autocommit", False):
+                cursor.execute(sql, parameters)
+                return cursor.fetchone()[0]
+
+            cursor.execute("SAVEPOINT auto_explain")
+            try:
+                cursor.execute(sql, parameters)
+                return cursor.fetchone()[0]
+            finally:
+                cursor.execute("ROLLBACK TO SAVEPOINT auto_explain")
+                cursor.execute("RELEASE SAVEPOINT auto_explain")
+
+    def _explain(self, dbapi_connection, statement, parameters):
+        is_select = statement.lstrip().upper().startswith(("SELECT", "WITH"))
+        autocommit = getattr(dbapi_connection, "autocommit", False)
+        if autocommit and not is_select:
+            prefix = ESTIMATE_PREFIX
+        else:
+            prefix = EXPLAIN_PREFIX
+        return self._run_isolated(dbapi_connection, prefix + statement, parameters)[0]
+
+    def _record(self, statement, elapsed, plan, seq_scans):
+        record = {
+            "captured_at": time.time(),
+            "sql": normalize_sql(statement),
+            "duration_ms": round(elapsed * 1000, 3),
+            "total_cost": plan["Plan"].get("Total Cost"),
+            "execution_ms": plan.get("Execution Time"),
+            "seq_scans": seq_scans,
+            "plan": plan,
+        }
+        self.plans.append(record)
+        if self.log_path:
+            with self._log_lock, open(self.log_path, "a") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+
+    def _large_seq_scans(self, dbapi_connection, node):
+        """
+        Returns the sequential scans of a plan tree on tables with more than
+        seq_scan_rows rows, according to the planner statistics
+        (pg_class.reltuples, cached per table).
+        """
+        found = []
+        if node.get("Node Type") == "Seq Scan":
+            table = node.get("Relation Name")
+            rows = self._table_rows.get(table)
+            if rows is None:
+                rows = self._run_isolated(
+                    dbapi_connection,
+                    "SELECT reltuples FROM pg_class WHERE relname = %(table)s",
+                    {"table": table},
+                )
+                rows = self._table_rows[table] = int(rows or 0)
+            if rows > self.seq_scan_rows:
+                found.append({"table": table, "table_rows": rows})
+        for child in node.get("Plans", ()):
+            found.extend(self._large_seq_scans(dbapi_connection, child))
+        return found
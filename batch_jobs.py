@@ -0,0 +1,82 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import func, select
+
+from db import get_engine
+from session import get_session
+
+
+def primary_key_column(model):
+    """
+    Returns the single integer primary key column of a model, e.g. Product.id.
+    """
+    primary_key = model.__mapper__.primary_key
+    if len(primary_key) != 1:
+        raise ValueError(f"{model.__name__} doesn't have a single-column primary key")
+    return primary_key[0]
+
+
+def pk_ranges(column, partitions):
+    """
+    Splits the [min(id), max(id)] range of a column into `partitions`
+    half-open ranges (lo, hi) of equal width.
+    Gaps in the ids only make some partitions smaller, no row is missed.
+    """
+    with get_session() as session:
+        low, high = session.execute(select(func.min(column), func.max(column))).one()
+    if low is None:
+        return []
+
+    # +1 because the last range is half-open and must still include max(id)
+    total = high - low + 1
+    partitions = max(1, min(partitions, total))
+    step = -(-total // partitions)  # ceiling division
+    return [(lo, min(lo + step, high + 1)) for lo in range(low, high + 1, step)]
+
+
+def _init_worker():
+    # with the "fork" start method the worker starts with a copy of the
+    # parent's pool. db.py already drops it after fork; doing it here as well
+    # keeps workers safe if the executor is created some other way.
+    get_engine().dispose(close=False)
+
+
+def _run_partition(job, lo, hi):
+    # every partition gets its own session and transaction
+    with get_session() as session:
+        return job(session, lo, hi)
+
+
+def run_partitioned(model, job, workers=None, partitions=None, column=None):
+    """
+    Runs job(session, lo, hi) over primary-key ranges of a table in parallel
+    processes, one session per partition, and returns the list of results
+    in range order.
+
+    job must be a module-level function (it is pickled to the workers), e.g.
+
+        def deactivate_unpriced(session, lo, hi):
+            result = session.execute(
+                update(Product)
+                .where(Product.id >= lo, Product.id < hi, Product.price == 0)
+                .values(is_active=False)
+            )
+            return result.rowcount
+
+        changed = sum(run_partitioned(Product, deactivate_unpriced))
+
+    By default there is one worker per CPU and four partitions per worker,
+    so a slow partition doesn't hold up the whole job.
+    """
+    column = column if column is not None else primary_key_column(model)
+    workers = workers or os.cpu_count() or 1
+    partitions = partitions or workers * 4
+
+    ranges = pk_ranges(column, partitions)
+    if not ranges:
+        return []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+        futures = [pool.submit(_run_partition, job, lo, hi) for lo, hi in ranges]
+        return [future.result() for future in futures]
@@ -0,0 +1,230 @@
+import sys
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import select
+
+from db import SessionLocal
+from session import _current_session
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class BatchUnitOfWork:
+    """
+    Wraps a session for jobs that touch a whole table.
+
+    Every `chunk_size` objects (or as soon as the identity map holds
+    `max_identity_map` objects) the pending changes are flushed and committed,
+    or released as a SAVEPOINT with use_savepoints=True, and the session is
+    emptied with expunge_all(). Memory therefore depends on the chunk size,
+    not on the size of the table.
+
+    Objects handed out by iterate() or passed to add() must not be used after
+    the next checkpoint: they are detached from the session by then. While
+    iterate() hands out a chunk, checkpoints are put off until the end of
+    the chunk, so the rest of it stays attached. To keep the identity map
+    under max_identity_map anyway, iterate() sizes every chunk to fit the
+    room left, counting the objects each row brought along in the previous
+    chunk (add()ed lines, loaded relationships, ...). The first chunk is a
+    single row, to measure that. Rows bringing along far more objects than
+    the ones before them can still overshoot the ceiling.
+    """
+
+    def __init__(
+        self,
+        session,
+        chunk_size=1000,
+        max_identity_map=5000,
+        use_savepoints=False,
+        trace_memory=False,
+    ):
+        self.session = session
+        self.chunk_size = chunk_size
+        self.max_identity_map = max_identity_map
+        self.use_savepoints = use_savepoints
+        self.trace_memory = trace_memory
+
+        self.checkpoints = 0
+        self.objects_processed = 0
+        self.peak_identity_map = 0
+        self.peak_objects_per_class = Counter()
+
+        self._pending = 0
+        # number of iterate() generators in the middle of handing out a chunk
+        self._in_chunk = 0
+        self._savepoint = session.begin_nested() if use_savepoints else None
+        if trace_memory:
+            tracemalloc.start()
+
+    def add(self, obj):
+        """
+        Adds a new object to the session, checkpointing when the chunk is full.
+        """
+        self.session.add(obj)
+        self.touched()
+
+    def touched(self, count=1):
+        """
+        Counts objects changed by the caller, checkpointing when the chunk is full.
+        """
+        self._pending += count
+        self.objects_processed += count
+        self._maybe_checkpoint()
+
+    def iterate(self, model, *where, chunk_size=None):
+        """
+        Yields every row of a model, loading it chunk by chunk in primary key
+        order (keyset pagination, so no server side cursor has to survive
+        the commits in between).
+        Checkpoints happen between chunks, once the caller is done with one.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        # one row first, to learn how many objects a row brings along
+        page_size = 1
+        primary_key = model.__mapper__.primary_key[0]
+        last_id = None
+        while True:
+            stmt = select(model).where(*where).order_by(primary_key).limit(page_size)
+            if last_id is not None:
+                stmt = stmt.where(primary_key > last_id)
+            size_before = self._session_size()
+            objects = self.session.scalars(stmt).all()
+            if not objects:
+                return
+            last_id = getattr(objects[-1], primary_key.key)
+
+            # only checkpoint between chunks: expunging in the middle of one
+            # would silently detach the objects the caller hasn't seen yet
+            self._in_chunk += 1
+            try:
+                yield from objects
+            finally:
+                self._in_chunk -= 1
+
+            count = len(objects)
+            del objects
+            # objects the chunk added to the session per row, rounded up
+            per_row = max(1, -(-(self._session_size() - size_before) // count))
+            self._pending += count
+            self.objects_processed += count
+            self._maybe_checkpoint()
+            room = self.max_identity_map - self._session_size()
+            if room < per_row and self._session_size():
+                # not even one more row fits
+                self.checkpoint()
+                room = self.max_identity_map - self._session_size()
+            page_size = max(1, min(chunk_size, room // per_row))
+
+    def checkpoint(self):
+        """
+        Writes the pending changes and empties the session.
+        """
+        self._record_identity_map()
+        if self.use_savepoints:
+            self._savepoint.commit()
+            self._savepoint = self.session.begin_nested()
+        else:
+            self.session.commit()
+        self.session.expunge_all()
+        self._pending = 0
+        self.checkpoints += 1
+
+    def report(self):
+        """
+        Returns the counters collected so far. Call it inside the
+        batch_session() block. peak_rss_kb is the peak resident size of the
+        whole process, peak_traced_bytes is only available with trace_memory=True.
+        """
+        report = {
+            "objects_processed": self.objects_processed,
+            "checkpoints": self.checkpoints,
+            "peak_identity_map": self.peak_identity_map,
+            "peak_objects_per_class": dict(self.peak_objects_per_class),
+        }
+        if resource is not None:
+            peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == "darwin":
+                # macOS reports bytes, Linux kilobytes
+                peak_rss //= 1024
+            report["peak_rss_kb"] = peak_rss
+        if self.trace_memory and tracemalloc.is_tracing():
+            report["peak_traced_bytes"] = tracemalloc.get_traced_memory()[1]
+        return report
+
+    def _maybe_checkpoint(self):
+        if self._in_chunk:
+            return
+        if (
+            self._pending >= self.chunk_size
+            or self._session_size() >= self.max_identity_map
+        ):
+            self.checkpoint()
+
+    def _session_size(self):
+        # new objects only enter the identity map once they are flushed
+        return len(self.session.identity_map) + len(self.session.new)
+
+    def _record_identity_map(self):
+        # new objects only enter the identity map once they are flushed
+        objects = list(self.session.identity_map.values()) + list(self.session.new)
+        self.peak_identity_map = max(self.peak_identity_map, len(objects))
+        for cls, count in Counter(type(obj).__name__ for obj in objects).items():
+            if count > self.peak_objects_per_class[cls]:
+                self.peak_objects_per_class[cls] = count
+
+    def _finish(self):
+        if self.use_savepoints:
+            self._record_identity_map()
+            self._savepoint.commit()
+        else:
+            self.checkpoint()
+        self.session.commit()
+
+    def _stop_tracing(self):
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+@contextmanager
+def batch_session(
+    chunk_size=1000, max_identity_map=5000, use_savepoints=False, trace_memory=False
+):
+    """
+    Like get_session(), but for jobs that process a whole table:
+
+        with batch_session(chunk_size=500) as batch:
+            for stock in batch.iterate(StockManagement):
+                stock.last_checked_at = now
+            print(batch.report())
+
+    By default every chunk is committed on its own, so a failure only rolls
+    back the current chunk. With use_savepoints=True the job runs in one
+    transaction (chunks are SAVEPOINTs) and a failure rolls back everything;
+    memory stays bounded either way. get_session() calls made inside the
+    block join the batch's session, and so its chunks.
+    """
+    session = SessionLocal()
+    batch = BatchUnitOfWork(
+        session,
+        chunk_size=chunk_size,
+        max_identity_map=max_identity_map,
+        use_savepoints=use_savepoints,
+        trace_memory=trace_memory,
+    )
+    token = _current_session.set(session)
+    try:
+        yield batch
+        batch._finish()
+    except Exception as e:
+        session.rollback()
+        print(f"Error: {e}")
+        raise
+    finally:
+        _current_session.reset(token)
+        batch._stop_tracing()
+        session.close()
@@ -0,0 +1,172 @@
+"""
+Query count and latency of every loading profile in loading_profiles.py.
+
+Each profile runs a typical page load that touches exactly what the page
+shows. The number of SQL statements is pinned: a profile change that adds a
+query (or a page that starts lazy loading) makes the benchmark fail, as does
+a median latency over the budget.
+
+Run from the project root:
+
+    python -m benchmarks.bench_loading_profiles --repeat 20
+"""
+
+import argparse
+import statistics
+import sys
+import time
+
+from sqlalchemy import event, select
+
+from benchmarks.seed import seed_catalog, seed_orders
+from db import get_engine
+from loading_profiles import with_profile
+from models import Order, Product, User
+from session import get_session
+
+
+def product_listing(session, ids):
+    products = session.scalars(
+        with_profile(
+            select(Product)
+            .where(Product.category_id == ids["category"])
+            .order_by(Product.id)
+            .limit(50),
+            "listing",
+        )
+    ).all()
+    return [(p.name, p.slug, p.price, p.category.name) for p in products]
+
+
+def product_detail(session, ids):
+    product = session.scalars(
+        with_profile(select(Product).where(Product.id == ids["product"]), "detail")
+    ).one()
+    return (
+        product.description,
+        product.category.name,
+        product.stock.quantity,
+        [promotion.name for promotion in product.promotion_event],
+    )
+
+
+def product_checkout(session, ids):
+    products = session.scalars(
+        with_profile(select(Product).where(Product.id.in_(ids["cart"])), "checkout")
+    ).all()
+    return [
+        (
+            p.price,
+            p.stock.quantity,
+            [promotion.price_reduction for promotion in p.promotion_event],
+        )
+        for p in products
+    ]
+
+
+def order_listing(session, ids):
+    orders = session.scalars(
+        with_profile(
+            select(Order)
+            .where(Order.user_id == ids["user"])
+            .order_by(Order.created_at.desc())
+            .limit(20),
+            "listing",
+        )
+    ).all()
+    return [(order.id, order.created_at, order.total) for order in orders]
+
+
+def order_detail(session, ids):
+    order = session.scalars(
+        with_profile(select(Order).where(Order.id == ids["order"]), "detail")
+    ).one()
+    return (
+        order.user.username,
+        [(line.product.name, line.quantity, line.unit_price) for line in order.lines],
+    )
+
+
+def user_orders(session, ids):
+    user = session.scalars(
+        with_profile(select(User).where(User.id == ids["user"]), "orders")
+    ).one()
+    return (user.username, [(order.id, order.total) for order in user.orders])
+
+
+# page -> (pinned number of statements, median latency budget in ms)
+PINS = {
+    product_listing: (1, 20),
+    product_detail: (2, 10),
+    product_checkout: (2, 10),
+    order_listing: (1, 10),
+    order_detail: (2, 10),
+    user_orders: (2, 20),
+}
+
+
+def measure(page, ids, repeat):
+    statements = []
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = get_engine()
+    timings = []
+    for _ in range(repeat):
+        # a fresh session each time, nothing may come from the identity map
+        with get_session() as session:
+            session.connection()  # connect outside the timing
+            statements.clear()
+            event.listen(engine, "before_cursor_execute", listener)
+            try:
+                start = time.perf_counter()
+                page(session, ids)
+                timings.append(time.perf_counter() - start)
+            finally:
+                event.remove(engine, "before_cursor_execute", listener)
+    return len(statements), statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with get_session() as session:
+        category_id = seed_catalog(session, products=1000)
+        user_id = seed_orders(session, category_id)
+        product_ids = session.scalars(
+            select(Product.id)
+            .where(Product.category_id == category_id)
+            .order_by(Product.id)
+            .limit(5)
+        ).all()
+        ids = {
+            "category": category_id,
+            "product": product_ids[0],
+            "cart": product_ids,
+            "user": user_id,
+            "order": session.scalar(
+                select(Order.id).where(Order.user_id == user_id).limit(1)
+            ),
+        }
+
+    failures = 0
+    for page, (pinned_queries, budget_ms) in PINS.items():
+        queries, median_ms = measure(page, ids, args.repeat)
+        problems = []
+        if queries != pinned_queries:
+            problems.append(f"{queries} queries, pinned at {pinned_queries}")
+        if median_ms > budget_ms:
+            problems.append(f"median over the {budget_ms}ms budget")
+        failures += bool(problems)
+        print(
+            f"{'FAIL' if problems else 'ok':<5} {page.__name__:<17} "
+            f"queries={queries:<3} median_ms={median_ms:>7.2f}  {'; '.join(problems)}"
+        )
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
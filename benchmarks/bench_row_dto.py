@@ -0,0 +1,74 @@
+"""
+Full ORM loading vs. __slots__ row objects for a product listing.
+
+Run from the project root:
+
+    python -m benchmarks.bench_row_dto --rows 50000
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import select
+
+from benchmarks.seed import seed_catalog
+from models import Product
+from row_dto import select_rows
+from session import get_session
+
+LISTING_COLUMNS = ("id", "name", "slug", "price")
+
+
+def load_orm(session, category_id):
+    stmt = select(Product).where(Product.category_id == category_id)
+    return session.scalars(stmt).all()
+
+
+def load_rows(session, category_id):
+    return select_rows(
+        session, Product, *LISTING_COLUMNS, where=[Product.category_id == category_id]
+    )
+
+
+def measure(name, loader, category_id, repeat):
+    # memory: peak traced allocations while one result list is alive
+    with get_session() as session:
+        gc.collect()
+        tracemalloc.start()
+        rows = loader(session, category_id)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        count = len(rows)
+        del rows
+
+    # speed: best of `repeat` runs, each on a fresh session (empty identity map)
+    best = float("inf")
+    for _ in range(repeat):
+        with get_session() as session:
+            start = time.perf_counter()
+            loader(session, category_id)
+            best = min(best, time.perf_counter() - start)
+
+    print(
+        f"{name:<6} rows={count:<8} bytes/row={peak / max(count, 1):>8.0f} "
+        f"rows/sec={count / best:>12,.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with get_session() as session:
+        category_id = seed_catalog(session, products=args.rows)
+
+    measure("orm", load_orm, category_id, args.repeat)
+    measure("slots", load_rows, category_id, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
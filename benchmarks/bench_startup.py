@@ -0,0 +1,117 @@
+"""
+Cold-start cost of the models package, as paid by short-lived job containers.
+
+Every measurement runs in a fresh interpreter:
+  - import models          (declaring the mapping)
+  - import models + configure()
+  - import session         (db.py, no engine yet)
+  - first query            (engine creation, connect, SELECT 1 through get_session)
+
+Run from the project root:
+
+    python -m benchmarks.bench_startup --runs 10
+    python -m benchmarks.bench_startup --profile 15   # slowest imports (-X importtime)
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {
+    "import models": "import models",
+    "import models + configure()": "import models; models.configure()",
+    "import session": "import session",
+    "first query": (
+        "from sqlalchemy import text\n"
+        "import models\n"
+        "from session import get_session\n"
+        "with get_session() as session:\n"
+        "    session.execute(text('SELECT 1'))"
+    ),
+}
+
+# times the scenario inside the child, so interpreter start-up isn't counted
+TIMER = """
+import time
+start = time.perf_counter()
+{code}
+print(time.perf_counter() - start)
+"""
+
+
+def run_once(code):
+    result = subprocess.run(
+        [sys.executable, "-c", TIMER.format(code=code)],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        lines = [
+            line
+            for line in result.stderr.strip().splitlines()
+            if line.strip() and not line.startswith("(Background on this error")
+        ]
+        return None, lines[-1]
+    return float(result.stdout.strip().splitlines()[-1]), None
+
+
+def measure(runs):
+    for name, code in SCENARIOS.items():
+        timings = []
+        for _ in range(runs):
+            seconds, error = run_once(code)
+            if seconds is None:
+                print(f"{name:<30} skipped: {error}")
+                break
+            timings.append(seconds * 1000)
+        else:
+            print(
+                f"{name:<30} median={statistics.median(timings):8.1f} ms "
+                f"min={min(timings):8.1f} ms"
+            )
+
+
+def profile_imports(top, module="models"):
+    """
+    Prints the modules with the highest cumulative import time,
+    parsed from `python -X importtime`.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PROJECT_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        # import time:  self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+
+    total = max((row[0] for row in rows), default=0)
+    print(f"import {module}: {total / 1000:.1f} ms cumulative")
+    for cumulative_us, self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{cumulative_us / 1000:8.1f} ms {self_us / 1000:8.1f} ms  {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--profile", type=int, metavar="TOP", default=0)
+    args = parser.parse_args()
+
+    if args.profile:
+        profile_imports(args.profile)
+    else:
+        measure(args.runs)
+
+
+if __name__ == "__main__":
+    main()
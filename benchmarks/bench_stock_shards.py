@@ -0,0 +1,95 @@
+"""
+Checkout throughput on one hot product: a single stock_management row vs.
+the same stock sharded over several stock_shard rows.
+
+Every worker thread runs checkouts in a loop; a checkout decrements the stock
+and holds its transaction open for --hold-ms (the rest of the checkout work)
+before committing. With one row all workers queue on its lock; with shards up
+to --slots of them proceed at once. Each --workers count is measured; with
+more workers than slots, buyers regularly find every slot locked and have to
+retry. PostgreSQL only.
+
+Run from the project root:
+
+    python -m benchmarks.bench_stock_shards --workers 12 32 --slots 16
+"""
+
+import argparse
+import threading
+import time
+
+from sqlalchemy import select, update
+
+from benchmarks.seed import seed_catalog
+from models import Product, StockManagement
+from session import get_session
+from stock_shards import decrement_stock, disable_sharding, enable_sharding, is_sharded
+
+STOCK = 10_000_000
+
+
+def prepare(product_id, slots):
+    with get_session() as session:
+        if is_sharded(session, product_id):
+            disable_sharding(session, product_id)
+        session.execute(
+            update(StockManagement)
+            .where(StockManagement.product_id == product_id)
+            .values(quantity=STOCK)
+        )
+        session.commit()
+        if slots:
+            enable_sharding(session, product_id, slots)
+
+
+def run(product_id, workers, seconds, hold):
+    done = [0] * workers
+    deadline = time.perf_counter() + seconds
+
+    def worker(index):
+        while time.perf_counter() < deadline:
+            with get_session() as session:
+                if not decrement_stock(session, product_id):
+                    raise RuntimeError("benchmark product sold out")
+                time.sleep(hold)
+            done[index] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(done) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[12, 32])
+    parser.add_argument("--slots", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--hold-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    with get_session() as session:
+        category_id = seed_catalog(session, products=1, prefix="shard")
+        product_id = session.scalar(
+            select(Product.id).where(Product.category_id == category_id).limit(1)
+        )
+
+    for workers in args.workers:
+        results = {}
+        for label, slots in (("single row", 0), (f"{args.slots} shards", args.slots)):
+            prepare(product_id, slots)
+            results[label] = run(product_id, workers, args.seconds, args.hold_ms / 1000)
+            print(
+                f"{workers:>3} workers  {label:<12} checkouts/sec={results[label]:>10,.0f}"
+            )
+
+        single, sharded = results.values()
+        print(f"speedup: {sharded / single:.1f}x with {workers} workers")
+    prepare(product_id, 0)
+
+
+if __name__ == "__main__":
+    main()
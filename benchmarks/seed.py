@@ -0,0 +1,126 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import func, insert, select, text
+
+from models import Category, Order, OrderProduct, Product, StockManagement, User
+
+
+def get_root_category(session, slug="bench"):
+    """
+    Returns the id of the category used by the benchmarks, creating it if needed.
+    """
+    category_id = session.scalar(select(Category.id).where(Category.slug == slug))
+    if category_id is not None:
+        return category_id
+
+    # category.category_id is a required self reference, so the very first
+    # category has to point to itself. Insert it with an explicit id...
+    category_id = (session.scalar(select(func.max(Category.id))) or 0) + 1
+    session.execute(
+        insert(Category).values(
+            id=category_id,
+            category_id=category_id,
+            name=slug,
+            slug=slug,
+            is_active=True,
+        )
+    )
+    # ...and move the serial sequence past it so normal inserts keep working
+    if session.bind.dialect.name == "postgresql":
+        session.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence('category', 'id'), "
+                "(SELECT max(id) FROM category))"
+            )
+        )
+    return category_id
+
+
+def seed_catalog(session, products=10_000, prefix="bench"):
+    """
+    Makes sure at least `products` benchmark products (with their stock rows)
+    exist and returns their category id. Running it again is cheap.
+    """
+    category_id = get_root_category(session, prefix)
+    existing = session.scalar(
+        select(func.count())
+        .select_from(Product)
+        .where(Product.category_id == category_id)
+    )
+    if existing >= products:
+        return category_id
+
+    now = datetime.now(timezone.utc)
+    rows = [
+        {
+            "category_id": category_id,
+            "name": f"{prefix} product {i}",
+            "slug": f"{prefix}-product-{i}",
+            "description": f"Benchmark product number {i}",
+            "is_active": i % 4 != 0,
+            "price": i % 500 + 0.99,
+            "updated_at": now,
+        }
+        for i in range(existing, products)
+    ]
+    product_ids = session.scalars(insert(Product).returning(Product.id), rows).all()
+    session.execute(
+        insert(StockManagement),
+        [
+            {
+                "product_id": product_id,
+                "quantity": product_id % 100,
+                "last_checked_at": now,
+            }
+            for product_id in product_ids
+        ],
+    )
+    return category_id
+
+
+def seed_orders(session, category_id, orders=200, lines=3, prefix="bench"):
+    """
+    Makes sure the benchmark user has at least `orders` orders of `lines`
+    products from the given category, and returns the user's id.
+    """
+    username = f"{prefix}_user"
+    user_id = session.scalar(select(User.id).where(User.username == username))
+    if user_id is None:
+        user_id = session.scalar(
+            insert(User)
+            .values(username=username, email=f"{username}@example.com", password="x")
+            .returning(User.id)
+        )
+    existing = session.scalar(
+        select(func.count()).select_from(Order).where(Order.user_id == user_id)
+    )
+    if existing >= orders:
+        return user_id
+
+    products = session.execute(
+        select(Product.id, Product.price)
+        .where(Product.category_id == category_id)
+        .order_by(Product.id)
+        .limit(lines * 10)
+    ).all()
+    now = datetime.now(timezone.utc)
+    order_ids = session.scalars(
+        insert(Order).returning(Order.id),
+        [{"user_id": user_id, "updated_at": now} for _ in range(existing, orders)],
+    ).all()
+    session.execute(
+        insert(OrderProduct),
+        [
+            {
+                "order_id": order_id,
+                "product_id": product_id,
+                "quantity": 1 + line,
+                "unit_price": price,
+            }
+            for n, order_id in enumerate(order_ids)
+            for line, (product_id, price) in enumerate(
+                products[(n + i) % len(products)] for i in range(lines)
+            )
+        ],
+    )
+    return user_id
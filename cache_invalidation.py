@@ -0,0 +1,162 @@
+import select
+import threading
+from collections import defaultdict
+
+from db import get_engine
+
+# channel used by notify_row_change() in models.py
+CHANNEL = "row_change"
+
+
+class LocalCache:
+    """
+    In-process cache of one table's rows, keyed like the NOTIFY payload
+    (the row id, or the product id for stock_management).
+
+        products = LocalCache("product")
+        listener.register(products)
+        product = products.get(42, lambda: load_product(42))
+    """
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self._data = {}
+        self._lock = threading.Lock()
+        # bumped by every invalidation, see get()
+        self._version = 0
+
+    def get(self, key, loader=None):
+        """
+        Returns the cached value, or calls loader() and caches its result.
+        """
+        try:
+            return self._data[key]
+        except KeyError:
+            if loader is None:
+                return None
+
+        version = self._version
+        value = loader()
+        with self._lock:
+            # If an invalidation arrived while we were loading, the value may
+            # already be stale: return it, but don't cache it.
+            if self._version == version:
+                self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ChangeListener:
+    """
+    Background thread that LISTENs on the row_change channel and invalidates
+    the registered LocalCaches.
+
+        listener = ChangeListener()
+        listener.register(products)
+        listener.start()
+
+    Start one listener per process, after forking: threads don't survive a fork.
+    NOTIFY is only delivered for committed transactions, and notifications
+    sent while the listener is disconnected are lost, so every (re)connect
+    clears all registered caches.
+    """
+
+    def __init__(self, engine=None, poll_interval=1.0, reconnect_delay=1.0):
+        self.engine = engine
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+
+        self.notifications = 0
+        self.reconnects = 0
+
+        self._caches = defaultdict(list)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def register(self, cache):
+        self._caches[cache.table_name].append(cache)
+        return cache
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="cache-invalidation-listener", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def handle(self, payload):
+        """
+        Applies one "<table>:<op>:<key>" payload to the caches.
+        """
+        table_name, _, key = payload.split(":", 2)
+        if key.isdigit():
+            key = int(key)
+        for cache in self._caches.get(table_name, ()):
+            cache.invalidate(key)
+        self.notifications += 1
+
+    def _clear_all(self):
+        for caches in self._caches.values():
+            for cache in caches:
+                cache.clear()
+
+    def _connect(self):
+        # a dedicated connection, taken out of the pool for good:
+        # it sits in LISTEN for the lifetime of the process
+        engine = self.engine if self.engine is not None else get_engine()
+        connection = engine.raw_connection()
+        connection.detach()
+        dbapi_connection = connection.dbapi_connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL}")
+        return dbapi_connection
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                dbapi_connection = self._connect()
+            except Exception as e:
+                print(f"Error: {e}")
+                self._stop.wait(self.reconnect_delay)
+                continue
+
+            self._clear_all()
+            try:
+                while not self._stop.is_set():
+                    ready, _, _ = select.select(
+                        [dbapi_connection], [], [], self.poll_interval
+                    )
+                    if not ready:
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        self.handle(dbapi_connection.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"Error: {e}")
+                self.reconnects += 1
+                self._stop.wait(self.reconnect_delay)
+            finally:
+                dbapi_connection.close()
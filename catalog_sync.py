@@ -0,0 +1,111 @@
+from datetime import datetime, timezone
+
+from sqlalchemy import select, update
+
+from models import PRODUCT_HASH_FIELDS, Product, product_content_hash
+from upserts import upsert
+
+
+class SyncReport:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        # rows whose content hash matched, nothing was written for them
+        self.skipped = 0
+
+    def __repr__(self):
+        return (
+            f"SyncReport(inserted={self.inserted}, updated={self.updated}, "
+            f"skipped={self.skipped})"
+        )
+
+
+def sync_products(session, rows, batch_size=500):
+    """
+    Applies a supplier feed (dicts of Product columns, keyed by slug) and only
+    writes the products that actually changed: per batch, the content hashes
+    of the incoming rows are compared with the stored ones in one query, and
+    only new or different rows go through upsert(). Unchanged rows keep their
+    updated_at and leave no dead tuples behind.
+
+        report = sync_products(session, feed)
+        print(f"{report.skipped} of {len(feed)} products unchanged")
+
+    Hashed fields the feed doesn't have (e.g. no is_digital) are left as
+    stored: the incoming hash is computed with the stored values for them,
+    and they are not written. New products get their column defaults.
+    Commits after each batch. Returns a SyncReport.
+    """
+    now = datetime.now(timezone.utc)
+
+    unique = {}
+    for row in rows:
+        row = dict(row)
+        row.setdefault("updated_at", now)
+        unique[row["slug"]] = row
+    if not unique:
+        return SyncReport()
+
+    # upsert() needs the same columns in every row, so these are the same too
+    missing = [
+        field
+        for field in PRODUCT_HASH_FIELDS
+        if field not in next(iter(unique.values()))
+    ]
+    missing_columns = [getattr(Product, field) for field in missing]
+
+    report = SyncReport()
+    items = list(unique.values())
+    for start in range(0, len(items), batch_size):
+        batch = items[start : start + batch_size]
+        stored = {
+            slug: (content_hash, dict(zip(missing, values)))
+            for slug, content_hash, *values in session.execute(
+                select(Product.slug, Product.content_hash, *missing_columns).where(
+                    Product.slug.in_([row["slug"] for row in batch])
+                )
+            )
+        }
+        changed = []
+        for row in batch:
+            stored_hash, kept = stored.get(row["slug"], (None, {}))
+            row["content_hash"] = product_content_hash({**kept, **row})
+            if row["content_hash"] != stored_hash:
+                changed.append(row)
+        report.skipped += len(batch) - len(changed)
+        for result in upsert(session, Product, changed):
+            if result.inserted:
+                report.inserted += 1
+            else:
+                report.updated += 1
+        session.commit()
+    return report
+
+
+def backfill_content_hashes(session, batch_size=1000):
+    """
+    Fills content_hash on products written before the column existed (or by
+    Core statements that bypassed the ORM listener). Returns the number of
+    rows updated.
+    """
+    filled = 0
+    last_id = 0
+    while True:
+        products = session.scalars(
+            select(Product)
+            .where(Product.id > last_id, Product.content_hash.is_(None))
+            .order_by(Product.id)
+            .limit(batch_size)
+        ).all()
+        if not products:
+            return filled
+        session.execute(
+            update(Product),
+            [
+                {"id": product.id, "content_hash": product_content_hash(product)}
+                for product in products
+            ],
+        )
+        session.commit()
+        filled += len(products)
+        last_id = products[-1].id
@@ -0,0 +1,123 @@
+from sqlalchemy import func, select, text, update
+
+from models import Category, CounterDelta, Order, Product, User
+
+# counter name (the table_name used in counter_delta)
+#   -> (counted model, counter column, child model, child foreign key)
+COUNTERS = {
+    "category": (Category, Category.product_count, Product, Product.category_id),
+    "user": (User, User.order_count, Order, Order.user_id),
+}
+
+fold_sql = text("""
+WITH moved AS (
+    DELETE FROM counter_delta
+    WHERE id IN (
+        SELECT id FROM counter_delta
+        ORDER BY id
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING table_name, row_id, delta
+),
+sums AS (
+    SELECT table_name, row_id, sum(delta) AS delta
+    FROM moved
+    GROUP BY table_name, row_id
+),
+categories AS (
+    UPDATE category SET product_count = category.product_count + sums.delta
+    FROM sums
+    WHERE sums.table_name = 'category' AND category.id = sums.row_id
+),
+users AS (
+    UPDATE "user" SET order_count = "user".order_count + sums.delta
+    FROM sums
+    WHERE sums.table_name = 'user' AND "user".id = sums.row_id
+)
+SELECT count(*) FROM moved
+""")
+
+
+def counter_value(session, name, row_id):
+    """
+    Returns the current value of a counter, e.g. counter_value(session, "category", 3).
+    Includes the changes still waiting in counter_delta, so it is exact
+    in both "direct" and "deferred" mode.
+    """
+    model, counter, _, _ = COUNTERS[name]
+    stored = session.scalar(select(counter).where(model.id == row_id))
+    pending = session.scalar(
+        select(func.coalesce(func.sum(CounterDelta.delta), 0)).where(
+            CounterDelta.table_name == name, CounterDelta.row_id == row_id
+        )
+    )
+    return (stored or 0) + pending
+
+
+def fold_counter_deltas(session, batch_size=10_000):
+    """
+    Sums pending counter_delta rows into the counter columns, one short
+    transaction per batch, and returns how many delta rows were folded.
+    SKIP LOCKED lets several folders run at the same time.
+    """
+    folded = 0
+    while True:
+        moved = session.execute(fold_sql, {"batch_size": batch_size}).scalar()
+        session.commit()
+        folded += moved
+        if moved < batch_size:
+            return folded
+
+
+def reconcile_counters(session, names=None, batch_size=1000):
+    """
+    Recomputes counters from the real rows and repairs the ones that drifted
+    (bulk loads with triggers disabled, TRUNCATE, manual fixes, ...).
+    Returns the number of repaired rows per counter.
+
+    Rows are processed in batches of batch_size, each batch in its own
+    transaction. The batch is locked with FOR UPDATE before counting, so a
+    concurrent insert either is already counted or bumps the counter after
+    the repair, never in between. Changes still pending in counter_delta are
+    subtracted, because fold_counter_deltas() will add them later.
+    """
+    repaired = {}
+    for name in names or COUNTERS:
+        model, counter, child, foreign_key = COUNTERS[name]
+
+        actual = (
+            select(func.count())
+            .select_from(child)
+            .where(foreign_key == model.id)
+            .scalar_subquery()
+        )
+        pending = (
+            select(func.coalesce(func.sum(CounterDelta.delta), 0))
+            .where(CounterDelta.table_name == name, CounterDelta.row_id == model.id)
+            .scalar_subquery()
+        )
+        expected = actual - pending
+
+        repaired[name] = 0
+        last_id = 0
+        while True:
+            ids = session.scalars(
+                select(model.id)
+                .where(model.id > last_id)
+                .order_by(model.id)
+                .limit(batch_size)
+                .with_for_update()
+            ).all()
+            if not ids:
+                break
+            result = session.execute(
+                update(model)
+                .where(model.id.in_(ids), counter != expected)
+                .values({counter: expected})
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            repaired[name] += result.rowcount
+            last_id = ids[-1]
+    return repaired
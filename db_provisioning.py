@@ -0,0 +1,161 @@
+"""
+Fast test databases: build the schema once into a template database, then
+give every test worker its own copy made with CREATE DATABASE ... TEMPLATE,
+which copies files instead of replaying the DDL.
+
+In a pytest conftest.py, for example:
+
+    @pytest.fixture(scope="session", autouse=True)
+    def database():
+        provision_worker_database()
+
+    @pytest.fixture(autouse=True)
+    def clean_tables():
+        yield
+        truncate_all()
+
+Works with pytest-xdist: each worker ("gw0", "gw1", ...) gets its own database.
+"""
+
+import hashlib
+import os
+from pathlib import Path
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+import db
+import models
+
+# arbitrary key for pg_advisory_lock, so only one worker builds the template
+TEMPLATE_LOCK_KEY = 72_136_001
+
+
+def _admin_engine(url):
+    # CREATE/DROP DATABASE can't run inside a transaction, and we can't be
+    # connected to the database we drop, so use the maintenance database
+    admin_url = make_url(url).set(database="postgres")
+    return create_engine(admin_url, isolation_level="AUTOCOMMIT")
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def schema_version():
+    """
+    Hash of models.py: the template is rebuilt whenever the models change.
+    """
+    return hashlib.sha1(Path(models.__file__).read_bytes()).hexdigest()[:12]
+
+
+def template_database_name(url=None):
+    return make_url(url or db.DATABASE_URL).database + "_template"
+
+
+def worker_database_url(worker_id=None, url=None):
+    """
+    URL of the database of one test worker, e.g. inventory_test_gw0.
+    """
+    worker_id = worker_id or os.environ.get("PYTEST_XDIST_WORKER", "main")
+    url = make_url(url or db.DATABASE_URL)
+    return url.set(database=f"{url.database}_test_{worker_id}")
+
+
+def build_template(url=None, force=False):
+    """
+    Creates the template database with the full schema (tables, constraints,
+    triggers) unless an up to date one already exists.
+    Returns the template's name.
+    """
+    url = url or db.DATABASE_URL
+    template = template_database_name(url)
+    version = schema_version()
+
+    admin = _admin_engine(url)
+    try:
+        with admin.connect() as connection:
+            connection.execute(
+                text("SELECT pg_advisory_lock(:key)"), {"key": TEMPLATE_LOCK_KEY}
+            )
+            try:
+                current = connection.execute(
+                    text(
+                        "SELECT shobj_description(oid, 'pg_database') "
+                        "FROM pg_database WHERE datname = :name"
+                    ),
+                    {"name": template},
+                ).first()
+                if current is not None and current[0] == version and not force:
+                    return template
+
+                if current is not None:
+                    connection.execute(
+                        text(f"ALTER DATABASE {_quote(template)} IS_TEMPLATE false")
+                    )
+                    connection.execute(text(f"DROP DATABASE {_quote(template)}"))
+                connection.execute(text(f"CREATE DATABASE {_quote(template)}"))
+
+                template_engine = create_engine(make_url(url).set(database=template))
+                try:
+                    models.Base.metadata.create_all(bind=template_engine)
+                finally:
+                    # no connection may stay open on a database used as template
+                    template_engine.dispose()
+
+                connection.execute(
+                    text(f"COMMENT ON DATABASE {_quote(template)} IS '{version}'")
+                )
+                connection.execute(
+                    text(f"ALTER DATABASE {_quote(template)} IS_TEMPLATE true")
+                )
+                return template
+            finally:
+                connection.execute(
+                    text("SELECT pg_advisory_unlock(:key)"), {"key": TEMPLATE_LOCK_KEY}
+                )
+    finally:
+        admin.dispose()
+
+
+def clone_database(name, template, url=None):
+    """
+    (Re)creates database `name` as a copy of `template`.
+    """
+    admin = _admin_engine(url or db.DATABASE_URL)
+    try:
+        with admin.connect() as connection:
+            connection.execute(
+                text(f"DROP DATABASE IF EXISTS {_quote(name)} WITH (FORCE)")
+            )
+            connection.execute(
+                text(f"CREATE DATABASE {_quote(name)} TEMPLATE {_quote(template)}")
+            )
+    finally:
+        admin.dispose()
+
+
+def provision_worker_database(worker_id=None, url=None):
+    """
+    Builds the template if needed, clones it for this worker and points
+    db.engine / SessionLocal at the clone. Returns the clone's URL.
+    """
+    template = build_template(url)
+    worker_url = worker_database_url(worker_id, url)
+    clone_database(worker_url.database, template, url)
+    db.configure_engine(worker_url)
+    return worker_url
+
+
+def truncate_all(engine=None):
+    """
+    Empties every table with a single TRUNCATE ... RESTART IDENTITY CASCADE,
+    children first. Much faster than drop_all/create_all, and the triggers
+    stay in place.
+    """
+    engine = engine or db.get_engine()
+    tables = ", ".join(
+        _quote(table.name) for table in reversed(models.Base.metadata.sorted_tables)
+    )
+    with engine.begin() as connection:
+        connection.execute(text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
@@ -0,0 +1,189 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from db import SessionLocal
+from session import _current_session
+
+# marker put on the queue by close() to stop the writer thread
+_STOP = object()
+
+
+class GroupCommitWriter:
+    """
+    Collects many small units of work from concurrent producers and commits
+    them together in a single transaction.
+
+    A unit of work is a callable that receives a session, e.g.
+
+        def place_order(session):
+            order = Order(user_id=user_id, ...)
+            session.add(order)
+            session.flush()
+            return order.id
+
+        with GroupCommitWriter(max_batch_size=200, max_wait_ms=5) as writer:
+            order_id = writer.write(place_order)
+
+    The writer waits at most max_wait_ms (or until max_batch_size items are
+    queued) before committing, so every caller pays one shared commit instead
+    of its own fsync round trip.
+    Each unit of work runs inside its own SAVEPOINT, so a failing item is rolled
+    back on its own and only that caller gets the exception.
+    If the final COMMIT fails, every item of the batch gets that error, and so
+    does every item not run yet when the batch fails as a whole (no session,
+    no SAVEPOINT). The writer then carries on with the next batch.
+
+    get_session() calls made by a unit of work join the batch's session, so
+    their writes stay inside the item's SAVEPOINT.
+
+    Return plain values (ids, numbers) from the unit of work: the session is
+    closed once the batch is committed, so ORM objects returned from it are detached.
+    """
+
+    def __init__(self, max_batch_size=100, max_wait_ms=5, session_factory=SessionLocal):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.session_factory = session_factory
+
+        self.batches_committed = 0
+        self.items_committed = 0
+        self.items_failed = 0
+
+        self._queue = queue.Queue()
+        # makes "not closed yet, queue it" atomic against close() queueing _STOP
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="group-commit-writer", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, work):
+        """
+        Queues a unit of work and returns a Future with its result.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("GroupCommitWriter is closed")
+            if not self._thread.is_alive():
+                raise RuntimeError("GroupCommitWriter thread is not running")
+            self._queue.put((work, future))
+        return future
+
+    def write(self, work, timeout=None):
+        """
+        Queues a unit of work and blocks until its batch is committed.
+        """
+        return self.submit(work).result(timeout)
+
+    def close(self):
+        """
+        Commits everything already queued and stops the writer thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            # the thread is going away: nothing queued from now on would run
+            with self._lock:
+                self._closed = True
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not _STOP and item[1].set_running_or_notify_cancel():
+                    item[1].set_exception(
+                        RuntimeError("GroupCommitWriter thread stopped")
+                    )
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+
+            # gather more items until the batch is full or the window is over
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            try:
+                self._commit_batch(batch)
+            except Exception as e:
+                # _commit_batch() has already failed the batch's futures
+                print(f"Error: group commit batch failed: {e}")
+
+    def _commit_batch(self, batch):
+        session = None
+        token = None
+        succeeded = []
+        try:
+            session = self.session_factory()
+            token = _current_session.set(session)
+            for work, future in batch:
+                # the caller cancelled the future before we got to it
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                savepoint = session.begin_nested()
+                try:
+                    result = work(session)
+                    # releasing the savepoint flushes the pending changes
+                    savepoint.commit()
+                except Exception as e:
+                    self.items_failed += 1
+                    future.set_exception(e)
+                    savepoint.rollback()
+                else:
+                    succeeded.append((future, result))
+
+            session.commit()
+        except Exception as e:
+            # the items that succeeded and those never run fail with the
+            # batch, before the rollback (which may fail too) is attempted
+            for _, future in batch:
+                if not future.done():
+                    self.items_failed += 1
+                    future.set_exception(e)
+            if session is not None:
+                session.rollback()
+            raise
+        else:
+            self.batches_committed += 1
+            self.items_committed += len(succeeded)
+            for future, result in succeeded:
+                future.set_result(result)
+        finally:
+            if token is not None:
+                _current_session.reset(token)
+            if session is not None:
+                session.close()
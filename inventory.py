@@ -0,0 +1,111 @@
+from sqlalchemy import func, insert, select, text, union_all
+
+from models import StockManagement, StockMovement, StockShard
+
+# Moves a batch of ledger entries into the stock_management snapshot, creating
+# the snapshot row of products that don't have one yet
+compact_sql = text("""
+WITH moved AS (
+    DELETE FROM stock_movement
+    WHERE id IN (
+        SELECT id FROM stock_movement
+        ORDER BY id
+        LIMIT :batch_size
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING product_id, delta, created_at
+),
+sums AS (
+    SELECT product_id, sum(delta) AS delta, max(created_at) AS checked_at
+    FROM moved
+    GROUP BY product_id
+),
+applied AS (
+    INSERT INTO stock_management (product_id, quantity, last_checked_at)
+    SELECT product_id, delta, checked_at FROM sums
+    ON CONFLICT (product_id) DO UPDATE SET
+        quantity = stock_management.quantity + excluded.quantity,
+        last_checked_at = greatest(
+            stock_management.last_checked_at, excluded.last_checked_at
+        )
+)
+SELECT count(*) FROM moved
+""")
+
+
+def record_movement(session, product_id, delta, reason=None):
+    """
+    Appends a stock change (negative for sales) to the ledger. Unlike updating
+    stock_management, concurrent movements of the same product don't wait for
+    each other. Doesn't commit.
+    """
+    session.execute(
+        insert(StockMovement),
+        {"product_id": product_id, "delta": delta, "reason": reason},
+    )
+
+
+def record_movements(session, movements):
+    """
+    Appends many movements ({"product_id", "delta", "reason"} dicts) with one
+    executemany. Doesn't commit.
+    """
+    movements = [{"reason": None, **movement} for movement in movements]
+    if movements:
+        session.execute(insert(StockMovement), movements)
+
+
+def available_quantities(session, product_ids):
+    """
+    Returns {product id: quantity} for the given products: the
+    stock_management snapshot, the stock shards of sharded products and the
+    movements not compacted yet. Products without any of them are reported
+    as 0.
+
+    Everything is read in one statement, so a compaction running at the same
+    time can't make a movement count twice or not at all.
+    """
+    parts = union_all(
+        select(StockManagement.product_id, StockManagement.quantity).where(
+            StockManagement.product_id.in_(product_ids)
+        ),
+        select(StockShard.product_id, StockShard.quantity).where(
+            StockShard.product_id.in_(product_ids)
+        ),
+        select(StockMovement.product_id, StockMovement.delta).where(
+            StockMovement.product_id.in_(product_ids)
+        ),
+    ).subquery()
+    quantities = dict.fromkeys(product_ids, 0)
+    quantities.update(
+        session.execute(
+            select(parts.c.product_id, func.sum(parts.c.quantity)).group_by(
+                parts.c.product_id
+            )
+        ).all()
+    )
+    return quantities
+
+
+def available_quantity(session, product_id):
+    return available_quantities(session, [product_id])[product_id]
+
+
+def compact_stock_ledger(session, batch_size=10_000):
+    """
+    Folds ledger entries into stock_management.quantity and last_checked_at,
+    one short transaction per batch, and returns how many entries were
+    folded. Each product's snapshot row is updated once per batch instead of
+    once per movement. SKIP LOCKED lets several compactors run at once.
+    PostgreSQL only, like fold_counter_deltas().
+
+    The ledger doesn't prevent overselling: a sale that must never take the
+    stock below zero still has to lock the snapshot row (or use stock shards).
+    """
+    compacted = 0
+    while True:
+        moved = session.execute(compact_sql, {"batch_size": batch_size}).scalar()
+        session.commit()
+        compacted += moved
+        if moved < batch_size:
+            return compacted
@@ -0,0 +1,125 @@
+"""
+Named eager-loading profiles: one agreed set of loader options per page type,
+instead of every caller picking (or forgetting) its own.
+
+    stmt = with_profile(select(Product).where(...), "listing")
+    order = session.scalars(
+        with_profile(select(Order).where(Order.id == order_id), "detail")
+    ).one()
+
+Profiles end with raiseload("*"): a relationship the profile doesn't load
+raises instead of quietly running one query per row, so a template that
+starts using a new relationship fails in tests rather than in production
+latency. The query count and latency of every profile are pinned by
+benchmarks/bench_loading_profiles.py.
+"""
+
+from sqlalchemy.orm import joinedload, load_only, raiseload, selectinload
+
+from models import Category, Order, OrderProduct, Product, PromotionEvent, User
+
+# {model: {profile name: loader options}}
+PROFILES = {}
+
+
+def register_profile(model, name, *options):
+    PROFILES.setdefault(model, {})[name] = options
+
+
+def loading_profile(model, name):
+    """
+    Returns the loader options of a profile, to pass to .options().
+    """
+    try:
+        return PROFILES[model][name]
+    except KeyError:
+        known = ", ".join(sorted(PROFILES.get(model, {}))) or "none"
+        raise KeyError(
+            f"no loading profile {name!r} for {model.__name__} (known: {known})"
+        ) from None
+
+
+def with_profile(stmt, name, model=None):
+    """
+    Applies a profile to a select(). The model defaults to the statement's
+    first entity.
+    """
+    if model is None:
+        model = stmt.column_descriptions[0]["entity"]
+    return stmt.options(*loading_profile(model, name))
+
+
+# Product
+
+# category pages and search results: a few columns, the category name
+register_profile(
+    Product,
+    "listing",
+    load_only(
+        Product.id,
+        Product.name,
+        Product.slug,
+        Product.price,
+        Product.is_active,
+        raiseload=True,
+    ),
+    joinedload(Product.category).load_only(Category.name, Category.slug),
+    raiseload("*"),
+)
+
+# product page: everything shown about one product
+register_profile(
+    Product,
+    "detail",
+    joinedload(Product.category),
+    joinedload(Product.stock),
+    selectinload(Product.promotion_event),
+    raiseload("*"),
+)
+
+# cart and checkout: what the price and the availability depend on
+register_profile(
+    Product,
+    "checkout",
+    load_only(
+        Product.id, Product.name, Product.price, Product.is_active, raiseload=True
+    ),
+    joinedload(Product.stock),
+    selectinload(Product.promotion_event).load_only(
+        PromotionEvent.start_date,
+        PromotionEvent.end_date,
+        PromotionEvent.price_reduction,
+    ),
+    raiseload("*"),
+)
+
+# Order
+
+# order history: totals only, skip the lines Order.lines loads by default
+register_profile(
+    Order,
+    "listing",
+    raiseload(Order.lines),
+    raiseload("*"),
+)
+
+# one order with its lines and their products
+register_profile(
+    Order,
+    "detail",
+    joinedload(Order.user).load_only(User.username, User.email),
+    selectinload(Order.lines)
+    .joinedload(OrderProduct.product)
+    .load_only(Product.name, Product.slug),
+    raiseload("*"),
+)
+
+# User
+
+# account page: the user with their order history (no lines)
+register_profile(
+    User,
+    "orders",
+    selectinload(User.orders).raiseload(Order.lines),
+    raiseload("*"),
+)
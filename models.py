@@ -1,3 +1,8 @@
+import hashlib
+import re
+import sqlite3
+from decimal import Decimal
+
 from sqlalchemy import (
     DDL,
     Boolean,
@@ -6,6 +11,7 @@ from sqlalchemy import (
     Date,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     Numeric,
     SmallInteger,
@@ -14,8 +20,10 @@ from sqlalchemy import (
     UniqueConstraint,
     event,
     func,
+    inspect,
 )
-from sqlalchemy.orm import DeclarativeBase, relationship
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import DeclarativeBase, configure_mappers, relationship
 
 # Define the SQL for the function and trigger
 trigger_sql = """
@@ -29,16 +37,270 @@ END;
 $$ LANGUAGE plpgsql;
 
 CREATE TRIGGER category_lowercase_trigger
-BEFORE INSERT OR UPDATE ON category
+BEFORE INSERT OR UPDATE OF name, slug ON category
 FOR EACH ROW
 EXECUTE FUNCTION lowercase_category_fields();
 """
 
+# Keeps order.total equal to the sum of its lines
+order_total_trigger_sql = """
+CREATE OR REPLACE FUNCTION update_order_total()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE "order" SET total = total - OLD.quantity * OLD.unit_price
+        WHERE id = OLD.order_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE "order" SET total = total + NEW.quantity * NEW.unit_price
+        WHERE id = NEW.order_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER order_total_trigger
+AFTER INSERT OR UPDATE OR DELETE ON order_product
+FOR EACH ROW
+EXECUTE FUNCTION update_order_total();
+"""
+
+# Change notifications for the in-process caches (see cache_invalidation.py).
+# Every committed change on a watched table sends a compact NOTIFY on the
+# "row_change" channel: "<table>:<I|U|D>:<key>", e.g. "product:U:42".
+# The key is the id of the row, or the column given as trigger argument
+# (stock_management sends its product_id, caches are keyed by product).
+notify_function_sql = """
+CREATE OR REPLACE FUNCTION notify_row_change()
+RETURNS TRIGGER AS $$
+DECLARE
+    changed record;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := OLD;
+    ELSE
+        changed := NEW;
+    END IF;
+    PERFORM pg_notify(
+        'row_change',
+        TG_TABLE_NAME || ':' || left(TG_OP, 1) || ':'
+            || (to_jsonb(changed) ->> coalesce(TG_ARGV[0], 'id'))
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+def notify_trigger_sql(table_name, key_column="id"):
+    return f"""
+CREATE TRIGGER {table_name}_notify_trigger
+AFTER INSERT OR UPDATE OR DELETE ON {table_name}
+FOR EACH ROW
+EXECUTE FUNCTION notify_row_change('{key_column}');
+"""
+
+
+# Denormalized counters: category.product_count and user.order_count are kept
+# up to date by triggers on product and order.
+# In the default "direct" mode the trigger updates the counter row right away.
+# A popular category then becomes a hot row every insert has to lock, so with
+#   ALTER DATABASE inventory SET app.counter_mode = 'deferred';
+# (or SET app.counter_mode for one session) the triggers only append a row to
+# counter_delta, which counters.fold_counter_deltas() later sums into the counters.
+counter_sql = """
+CREATE OR REPLACE FUNCTION bump_counter(counted_table text, counted_id integer, delta integer)
+RETURNS void AS $$
+BEGIN
+    IF current_setting('app.counter_mode', true) = 'deferred' THEN
+        INSERT INTO counter_delta (table_name, row_id, delta)
+        VALUES (counted_table, counted_id, delta);
+    ELSIF counted_table = 'category' THEN
+        UPDATE category SET product_count = product_count + delta WHERE id = counted_id;
+    ELSIF counted_table = 'user' THEN
+        UPDATE "user" SET order_count = order_count + delta WHERE id = counted_id;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+product_counter_trigger_sql = """
+CREATE OR REPLACE FUNCTION count_category_products()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM bump_counter('category', NEW.category_id, 1);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM bump_counter('category', OLD.category_id, -1);
+    ELSIF NEW.category_id IS DISTINCT FROM OLD.category_id THEN
+        PERFORM bump_counter('category', OLD.category_id, -1);
+        PERFORM bump_counter('category', NEW.category_id, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER category_product_count_trigger
+AFTER INSERT OR DELETE OR UPDATE OF category_id ON product
+FOR EACH ROW
+EXECUTE FUNCTION count_category_products();
+"""
+
+order_counter_trigger_sql = """
+CREATE OR REPLACE FUNCTION count_user_orders()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM bump_counter('user', NEW.user_id, 1);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM bump_counter('user', OLD.user_id, -1);
+    ELSIF NEW.user_id IS DISTINCT FROM OLD.user_id THEN
+        PERFORM bump_counter('user', OLD.user_id, -1);
+        PERFORM bump_counter('user', NEW.user_id, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER user_order_count_trigger
+AFTER INSERT OR DELETE OR UPDATE OF user_id ON "order"
+FOR EACH ROW
+EXECUTE FUNCTION count_user_orders();
+"""
+
+
+# SQLite versions of the triggers above, so the same models can be created on
+# an in-memory or file SQLite database (local benchmarks, read-only replicas).
+# SQLite triggers can't modify NEW, so they fix the row with an UPDATE after
+# the fact, and sqlite3 only runs one statement per call, hence one DDL each.
+# The deferred counter mode and the change notifications are PostgreSQL only.
+sqlite_category_trigger_sql = [
+    """
+CREATE TRIGGER category_lowercase_insert_trigger
+AFTER INSERT ON category
+FOR EACH ROW
+BEGIN
+    UPDATE category SET name = lower(NEW.name), slug = lower(NEW.slug)
+    WHERE id = NEW.id;
+END;
+""",
+    """
+CREATE TRIGGER category_lowercase_update_trigger
+AFTER UPDATE OF name, slug ON category
+FOR EACH ROW
+BEGIN
+    UPDATE category SET name = lower(NEW.name), slug = lower(NEW.slug)
+    WHERE id = NEW.id;
+END;
+""",
+]
+
+
+def sqlite_counter_trigger_sql(child, foreign_key, parent, counter):
+    return [
+        f"""
+CREATE TRIGGER {parent}_{counter}_insert_trigger
+AFTER INSERT ON "{child}"
+FOR EACH ROW
+BEGIN
+    UPDATE "{parent}" SET {counter} = {counter} + 1 WHERE id = NEW.{foreign_key};
+END;
+""",
+        f"""
+CREATE TRIGGER {parent}_{counter}_delete_trigger
+AFTER DELETE ON "{child}"
+FOR EACH ROW
+BEGIN
+    UPDATE "{parent}" SET {counter} = {counter} - 1 WHERE id = OLD.{foreign_key};
+END;
+""",
+        f"""
+CREATE TRIGGER {parent}_{counter}_update_trigger
+AFTER UPDATE OF {foreign_key} ON "{child}"
+FOR EACH ROW
+WHEN OLD.{foreign_key} IS NOT NEW.{foreign_key}
+BEGIN
+    UPDATE "{parent}" SET {counter} = {counter} - 1 WHERE id = OLD.{foreign_key};
+    UPDATE "{parent}" SET {counter} = {counter} + 1 WHERE id = NEW.{foreign_key};
+END;
+""",
+    ]
+
+
+sqlite_order_total_trigger_sql = [
+    """
+CREATE TRIGGER order_total_insert_trigger
+AFTER INSERT ON order_product
+FOR EACH ROW
+BEGIN
+    UPDATE "order" SET total = total + NEW.quantity * NEW.unit_price
+    WHERE id = NEW.order_id;
+END;
+""",
+    """
+CREATE TRIGGER order_total_delete_trigger
+AFTER DELETE ON order_product
+FOR EACH ROW
+BEGIN
+    UPDATE "order" SET total = total - OLD.quantity * OLD.unit_price
+    WHERE id = OLD.order_id;
+END;
+""",
+    """
+CREATE TRIGGER order_total_update_trigger
+AFTER UPDATE ON order_product
+FOR EACH ROW
+BEGIN
+    UPDATE "order" SET total = total - OLD.quantity * OLD.unit_price
+    WHERE id = OLD.order_id;
+    UPDATE "order" SET total = total + NEW.quantity * NEW.unit_price
+    WHERE id = NEW.order_id;
+END;
+""",
+]
+
+
+def listen_ddl(target, postgresql=None, sqlite=()):
+    """
+    Runs the given DDL after `target` is created, on the matching dialect only.
+    """
+    if postgresql is not None:
+        event.listen(
+            target, "after_create", DDL(postgresql).execute_if(dialect="postgresql")
+        )
+    for statement in sqlite:
+        event.listen(
+            target, "after_create", DDL(statement).execute_if(dialect="sqlite")
+        )
+
+
+# SQLite has the REGEXP operator but no function behind it, register one
+# (and turn on foreign keys, off by default, so RESTRICT is enforced)
+def _sqlite_regexp(pattern, value):
+    return value is not None and re.search(pattern, value) is not None
+
+
+@event.listens_for(Engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(
+            "regexp", 2, _sqlite_regexp, deterministic=True
+        )
+        dbapi_connection.execute("PRAGMA foreign_keys = ON")
+
 
 class Base(DeclarativeBase):
     pass
 
 
+# the function is shared by several tables, create it before any of them
+event.listen(
+    Base.metadata,
+    "before_create",
+    DDL(notify_function_sql).execute_if(dialect="postgresql"),
+)
+
+
 class Category(Base):
     __tablename__ = "category"
 
@@ -49,6 +311,8 @@ class Category(Base):
     slug = Column(String(55), nullable=False, unique=True)
     is_active = Column(Boolean, nullable=False, default=False)
     level = Column(SmallInteger, nullable=False, default=0)
+    # maintained by category_product_count_trigger, see counter_sql
+    product_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     product = relationship("Product", back_populates="category")
 
@@ -62,7 +326,8 @@ def lowercase_category_fields(mapper, connection, target):
         target.slug = target.slug.lower()
 
 
-event.listen(Category.__table__, "after_create", DDL(trigger_sql))
+listen_ddl(Category.__table__, trigger_sql, sqlite=sqlite_category_trigger_sql)
+listen_ddl(Category.__table__, notify_trigger_sql("category"))
 
 
 class PromotionEvent(Base):
@@ -82,6 +347,9 @@ class PromotionEvent(Base):
     )
 
 
+listen_ddl(PromotionEvent.__table__, notify_trigger_sql("promotion_event"))
+
+
 class Product(Base):
     __tablename__ = "product"
 
@@ -96,6 +364,8 @@ class Product(Base):
     created_at = Column(DateTime, default=func.now(), nullable=False)
     updated_at = Column(DateTime, onupdate=func.now(), nullable=False)
     price = Column(Numeric(10, 2), nullable=False)  # 10 digits, 2 decimal places
+    # hash of PRODUCT_HASH_FIELDS, see product_content_hash()
+    content_hash = Column(String(40), nullable=True)
 
     category = relationship("Category", back_populates="product")
 
@@ -115,10 +385,121 @@ class Product(Base):
     __table_args__ = (
         CheckConstraint("name <> ''", name="check_category_name_not_empty"),
         CheckConstraint("slug <> ''", name="check_category_slug_not_empty"),
-        CheckConstraint("slug ~ '^[a-z0-9_-]+$'", name="check_category_slug_format"),
+        # "~" is PostgreSQL only, SQLite gets the same rule with REGEXP
+        CheckConstraint(
+            "slug ~ '^[a-z0-9_-]+$'", name="check_category_slug_format"
+        ).ddl_if(dialect="postgresql"),
+        CheckConstraint(
+            "slug REGEXP '^[a-z0-9_-]+$'", name="check_category_slug_format"
+        ).ddl_if(dialect="sqlite"),
+        # "active products in a category" listing
+        Index("ix_product_category_active", "category_id", "is_active"),
     )
 
 
+# the columns a catalog sync compares, see catalog_sync.py
+PRODUCT_HASH_FIELDS = (
+    "category_id",
+    "name",
+    "description",
+    "is_digital",
+    "is_active",
+    "price",
+)
+
+
+def product_content_hash(values):
+    """
+    sha1 of the PRODUCT_HASH_FIELDS of a product, given as a dict (a feed row)
+    or an object. Values are normalized first, so 9.9, "9.90" and
+    Decimal("9.90") hash the same, and missing values count as their
+    column default.
+    """
+    get = values.get if isinstance(values, dict) else values.__dict__.get
+    parts = []
+    for field in PRODUCT_HASH_FIELDS:
+        value = get(field)
+        default = Product.__table__.c[field].default
+        if value is None and default is not None and default.is_scalar:
+            # not set yet, the INSERT will use the column default
+            value = default.arg
+        if field == "price" and value is not None:
+            value = Decimal(str(value)).quantize(Decimal("0.01"))
+        elif isinstance(value, bool):
+            value = int(value)
+        parts.append("" if value is None else str(value))
+    return hashlib.sha1("\x1f".join(parts).encode()).hexdigest()
+
+
+@event.listens_for(Product, "before_insert")
+@event.listens_for(Product, "before_update")
+def update_content_hash(mapper, connection, target):
+    # Core inserts/updates bypass this: catalog_sync and upsert() compute the
+    # hash themselves, product_content_hash_trigger clears it on other writes
+    state = inspect(target)
+    if state.key is None or any(
+        state.attrs[field].history.has_changes() for field in PRODUCT_HASH_FIELDS
+    ):
+        for field in PRODUCT_HASH_FIELDS:
+            # load expired attributes so they are in __dict__
+            getattr(target, field)
+        target.content_hash = product_content_hash(target)
+
+
+# Writes that bypass update_content_hash (Core and bulk updates, upserts of
+# some columns, raw SQL) change hashed columns without a new hash. The stored
+# hash then no longer describes the row: clear it, so the next catalog sync
+# rewrites the product instead of skipping it.
+_hash_columns_changed = " OR ".join(
+    f"NEW.{field} IS DISTINCT FROM OLD.{field}" for field in PRODUCT_HASH_FIELDS
+)
+
+content_hash_trigger_sql = f"""
+CREATE OR REPLACE FUNCTION clear_product_content_hash()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.content_hash IS NOT DISTINCT FROM OLD.content_hash
+        AND ({_hash_columns_changed}) THEN
+        NEW.content_hash := NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER product_content_hash_trigger
+BEFORE UPDATE ON product
+FOR EACH ROW
+EXECUTE FUNCTION clear_product_content_hash();
+"""
+
+sqlite_content_hash_trigger_sql = [
+    f"""
+CREATE TRIGGER product_content_hash_trigger
+AFTER UPDATE ON product
+FOR EACH ROW
+WHEN NEW.content_hash IS OLD.content_hash
+    AND ({_hash_columns_changed.replace("IS DISTINCT FROM", "IS NOT")})
+BEGIN
+    UPDATE product SET content_hash = NULL WHERE id = NEW.id;
+END;
+"""
+]
+
+listen_ddl(
+    Product.__table__,
+    content_hash_trigger_sql,
+    sqlite=sqlite_content_hash_trigger_sql,
+)
+listen_ddl(
+    Product.__table__,
+    product_counter_trigger_sql,
+    sqlite=sqlite_counter_trigger_sql(
+        "product", "category_id", "category", "product_count"
+    ),
+)
+listen_ddl(Product.__table__, notify_trigger_sql("product"))
+
+
 class ProductPromotionEvent(Base):
     __tablename__ = "product_promotion_event"
 
@@ -150,6 +531,54 @@ class StockManagement(Base):
 
     product = relationship("Product", back_populates="stock")
 
+    __table_args__ = (
+        # stalest rows first, for the stock_audit workers
+        Index("ix_stock_management_last_checked_at", "last_checked_at"),
+    )
+
+
+listen_ddl(
+    StockManagement.__table__, notify_trigger_sql("stock_management", "product_id")
+)
+
+
+# Append-only log of stock changes. Writers insert here instead of updating
+# the single stock_management row of a product; inventory.compact_stock_ledger()
+# folds the entries into stock_management.quantity.
+class StockMovement(Base):
+    __tablename__ = "stock_movement"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(ForeignKey("product.id", ondelete="RESTRICT"), nullable=False)
+
+    delta = Column(Integer, nullable=False)
+    reason = Column(String(50), nullable=True)
+    created_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()
+    )
+
+    __table_args__ = (
+        # pending movements of one product, for available_quantity()
+        Index("ix_stock_movement_product_id", "product_id"),
+        CheckConstraint("delta <> 0", name="check_stock_movement_delta_not_zero"),
+    )
+
+
+# Stock of a hot product spread over several rows, so concurrent buyers lock
+# different rows. See stock_shards.py; a product without shard rows keeps its
+# whole stock in stock_management.
+class StockShard(Base):
+    __tablename__ = "stock_shard"
+
+    product_id = Column(ForeignKey("product.id", ondelete="RESTRICT"), primary_key=True)
+    slot = Column(SmallInteger, primary_key=True)
+
+    quantity = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        CheckConstraint("quantity >= 0", name="check_stock_shard_quantity_positive"),
+    )
+
 
 class User(Base):
     __tablename__ = "user"
@@ -158,6 +587,8 @@ class User(Base):
     username = Column(String(50), nullable=False, unique=True)
     email = Column(String(255), nullable=False, unique=True)
     password = Column(String(100), nullable=False)
+    # maintained by user_order_count_trigger, see counter_sql
+    order_count = Column(Integer, nullable=False, default=0, server_default="0")
 
     orders = relationship("Order", back_populates="user")
 
@@ -170,12 +601,135 @@ class Order(Base):
 
     created_at = Column(DateTime, default=func.now(), nullable=False)
     updated_at = Column(DateTime, onupdate=func.now(), nullable=False)
+    # sum of quantity * unit_price of the lines, maintained by order_total_trigger
+    # so order history pages never have to aggregate the lines.
+    # It is computed by the database: refresh the object to see the new value.
+    total = Column(Numeric(12, 2), nullable=False, default=0, server_default="0")
 
     user = relationship("User", back_populates="orders")
 
+    # selectin: loading a list of orders fetches all their lines
+    # with one extra "WHERE order_id IN (...)" query instead of one per order
+    lines = relationship(
+        "OrderProduct",
+        back_populates="order",
+        lazy="selectin",
+        cascade="all, delete-orphan",
+    )
+
+    __table_args__ = (
+        # a user's order history, newest first
+        Index("ix_order_user_created", "user_id", "created_at"),
+    )
+
+    def add_line(self, product, quantity):
+        """
+        Adds a line for a product, freezing its current price. Lines are
+        keyed by order and product, so adding a product the order already
+        has increases that line's quantity and keeps its first price.
+        """
+        for line in self.lines:
+            if line.product is product or (
+                product.id is not None and line.product_id == product.id
+            ):
+                line.quantity += quantity
+                return line
+        line = OrderProduct(
+            product=product, quantity=quantity, unit_price=product.price
+        )
+        self.lines.append(line)
+        return line
+
+
+listen_ddl(
+    Order.__table__,
+    order_counter_trigger_sql,
+    sqlite=sqlite_counter_trigger_sql("order", "user_id", "user", "order_count"),
+)
+
 
 class OrderProduct(Base):
     __tablename__ = "order_product"
 
+    # one line per product in an order
+    order_id = Column(ForeignKey("order.id", ondelete="RESTRICT"), primary_key=True)
+    product_id = Column(ForeignKey("product.id", ondelete="RESTRICT"), primary_key=True)
+
+    quantity = Column(Integer, nullable=False)
+    # price at the time of the order, later price changes must not alter it
+    unit_price = Column(Numeric(10, 2), nullable=False)
+
+    order = relationship("Order", back_populates="lines")
+    product = relationship("Product")
+
+    __table_args__ = (
+        # the primary key index starts with order_id, this one serves
+        # "orders containing product X" and the FK check when deleting products
+        Index("ix_order_product_product_id", "product_id"),
+        CheckConstraint("quantity > 0", name="check_order_product_quantity_positive"),
+    )
+
+
+listen_ddl(
+    OrderProduct.__table__,
+    order_total_trigger_sql,
+    sqlite=sqlite_order_total_trigger_sql,
+)
+
+
+class CounterDelta(Base):
+    """
+    Pending counter changes written by the triggers in "deferred" counter mode.
+    """
+
+    __tablename__ = "counter_delta"
+
     id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String(50), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    delta = Column(Integer, nullable=False)
+
+    __table_args__ = (Index("ix_counter_delta_row", "table_name", "row_id"),)
+
+
+listen_ddl(CounterDelta.__table__, counter_sql)
+
+
+# Old orders moved out of the hot tables by archival.py. Same columns, but no
+# foreign keys, so products and users can still be removed later.
+class OrderArchive(Base):
+    __tablename__ = "order_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer, nullable=False)
+
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+    total = Column(Numeric(12, 2), nullable=False)
+    archived_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    __table_args__ = (Index("ix_order_archive_user_created", "user_id", "created_at"),)
+
+
+class OrderProductArchive(Base):
+    __tablename__ = "order_product_archive"
+
+    order_id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+
     quantity = Column(Integer, nullable=False)
+    unit_price = Column(Numeric(10, 2), nullable=False)
+
+
+def configure():
+    """
+    Resolves all relationships (the "Product", "StockManagement", ... strings)
+    and builds the mappers right now.
+
+    Importing this module only declares the classes; SQLAlchemy configures
+    the mappers lazily on the first query, so short-lived scripts that touch
+    one table don't pay for the whole mapping. Long-running servers should
+    call configure() at startup instead, so the first request doesn't pay
+    for it and mapping errors show up before any traffic.
+    """
+    configure_mappers()
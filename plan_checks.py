@@ -0,0 +1,287 @@
+"""
+Query-plan regression checks for the canonical access paths.
+
+Each CanonicalQuery declares a query against the models and the plan
+properties it must keep on a seeded dataset: the index it has to use, the
+largest sequential scan it may do and an estimated cost budget.
+A model or index change that silently turns one of them into a full table
+scan makes the check fail.
+
+    python -m plan_checks          # seeds if needed, prints the report
+
+or from pytest, in a throwaway database: test_plan_checks.py. The seeded
+dataset is committed, so don't point either at a database you care about.
+
+PostgreSQL only: the plans come from EXPLAIN (ANALYZE, FORMAT JSON).
+"""
+
+import sys
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import insert, select
+
+from benchmarks.seed import get_root_category
+from models import (
+    Base,
+    Category,
+    Order,
+    Product,
+    ProductPromotionEvent,
+    PromotionEvent,
+    User,
+)
+from session import get_session
+
+PREFIX = "plan"
+
+
+class CanonicalQuery:
+    def __init__(
+        self, name, build, uses_index=None, max_seq_scan_rows=1000, max_cost=None
+    ):
+        self.name = name
+        # build(session) -> the select() to explain, using seeded values
+        self.build = build
+        self.uses_index = uses_index
+        self.max_seq_scan_rows = max_seq_scan_rows
+        self.max_cost = max_cost
+
+
+def _first(session, column, *where):
+    return session.scalar(select(column).where(*where).order_by(column).limit(1))
+
+
+def product_by_slug(session):
+    return select(Product).where(Product.slug == f"{PREFIX}-product-3-42")
+
+
+def active_products_in_category(session):
+    category_id = _first(session, Category.id, Category.slug == f"{PREFIX}-category-3")
+    return (
+        select(Product)
+        .where(Product.category_id == category_id, Product.is_active.is_(True))
+        .order_by(Product.id)
+    )
+
+
+def user_orders_by_date(session):
+    user_id = _first(session, User.id, User.username == f"{PREFIX}_user_42")
+    return (
+        select(Order)
+        .where(Order.user_id == user_id)
+        .order_by(Order.created_at.desc())
+        .limit(20)
+    )
+
+
+def promotions_for_product(session):
+    product_id = _first(session, Product.id, Product.slug == f"{PREFIX}-product-3-42")
+    return (
+        select(PromotionEvent)
+        .join(
+            ProductPromotionEvent,
+            ProductPromotionEvent.promotion_event_id == PromotionEvent.id,
+        )
+        .where(ProductPromotionEvent.product_id == product_id)
+    )
+
+
+CANONICAL_QUERIES = [
+    CanonicalQuery(
+        "product by slug", product_by_slug, uses_index="product_slug_key", max_cost=20
+    ),
+    CanonicalQuery(
+        "active products in a category",
+        active_products_in_category,
+        uses_index="ix_product_category_active",
+        max_cost=500,
+    ),
+    CanonicalQuery(
+        "user's orders by date",
+        user_orders_by_date,
+        uses_index="ix_order_user_created",
+        max_cost=100,
+    ),
+    CanonicalQuery(
+        "promotions for a product",
+        promotions_for_product,
+        uses_index="unique_product_event",
+        max_cost=100,
+    ),
+]
+
+
+def seed_plan_dataset(session, categories=50, products_per_category=200, users=2000):
+    """
+    Seeds a dataset big enough for the planner to prefer indexes
+    (skipped if it is already there) and refreshes the statistics.
+    """
+    if _first(session, Category.id, Category.slug == f"{PREFIX}-category-0") is None:
+        now = datetime.now(timezone.utc)
+        root_id = get_root_category(session, PREFIX)
+        category_ids = session.scalars(
+            insert(Category).returning(Category.id),
+            [
+                {
+                    "category_id": root_id,
+                    "name": f"{PREFIX} category {c}",
+                    "slug": f"{PREFIX}-category-{c}",
+                    "is_active": True,
+                }
+                for c in range(categories)
+            ],
+        ).all()
+        product_ids = session.scalars(
+            insert(Product).returning(Product.id),
+            [
+                {
+                    "category_id": category_id,
+                    "name": f"{PREFIX} product {c}-{i}",
+                    "slug": f"{PREFIX}-product-{c}-{i}",
+                    "description": "plan check product",
+                    "is_active": i % 10 == 0,
+                    "price": 9.99,
+                    "updated_at": now,
+                }
+                for c, category_id in enumerate(category_ids)
+                for i in range(products_per_category)
+            ],
+        ).all()
+        user_ids = session.scalars(
+            insert(User).returning(User.id),
+            [
+                {
+                    "username": f"{PREFIX}_user_{u}",
+                    "email": f"{PREFIX}_user_{u}@example.com",
+                    "password": "x",
+                }
+                for u in range(users)
+            ],
+        ).all()
+        session.execute(
+            insert(Order),
+            [
+                {
+                    "user_id": user_id,
+                    "created_at": now - timedelta(days=d),
+                    "updated_at": now,
+                }
+                for user_id in user_ids
+                for d in range(10)
+            ],
+        )
+        event_ids = session.scalars(
+            insert(PromotionEvent).returning(PromotionEvent.id),
+            [
+                {
+                    "name": f"{PREFIX} promotion {e}",
+                    "start_date": date(2025, 1, 1),
+                    "end_date": date(2025, 12, 31),
+                    "price_reduction": 10,
+                }
+                for e in range(20)
+            ],
+        ).all()
+        session.execute(
+            insert(ProductPromotionEvent),
+            [
+                {"product_id": product_id, "promotion_event_id": event_ids[p % 20]}
+                for p, product_id in enumerate(product_ids)
+            ],
+        )
+        session.commit()
+
+    # fresh statistics, otherwise the planner still thinks the tables are empty
+    connection = session.connection()
+    for table in Base.metadata.sorted_tables:
+        connection.exec_driver_sql(
+            f"ANALYZE {connection.dialect.identifier_preparer.format_table(table)}"
+        )
+
+
+def explain(session, stmt):
+    """
+    Returns the JSON plan of a select() as executed on the seeded data.
+    """
+    connection = session.connection()
+    compiled = stmt.compile(
+        dialect=connection.dialect, compile_kwargs={"render_postcompile": True}
+    )
+    result = connection.exec_driver_sql(
+        "EXPLAIN (ANALYZE, FORMAT JSON) " + str(compiled), compiled.params
+    )
+    return result.scalar()[0]["Plan"]
+
+
+def _walk(node):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from _walk(child)
+
+
+def plan_violations(query, plan):
+    """
+    Returns the list of broken expectations for one plan (empty if fine).
+    """
+    problems = []
+    nodes = list(_walk(plan))
+
+    if query.uses_index is not None:
+        indexes = {node["Index Name"] for node in nodes if "Index Name" in node}
+        if query.uses_index not in indexes:
+            used = ", ".join(sorted(indexes)) or "no index"
+            problems.append(f"expected index {query.uses_index}, plan uses {used}")
+
+    for node in nodes:
+        if node["Node Type"] != "Seq Scan":
+            continue
+        loops = node.get("Actual Loops", 1)
+        rows = node.get("Actual Rows", 0) + node.get("Rows Removed by Filter", 0)
+        scanned = rows * loops
+        if scanned > query.max_seq_scan_rows:
+            problems.append(
+                f"seq scan on {node['Relation Name']} read {scanned} rows "
+                f"(limit {query.max_seq_scan_rows})"
+            )
+
+    if query.max_cost is not None and plan["Total Cost"] > query.max_cost:
+        problems.append(
+            f"estimated cost {plan['Total Cost']} over budget {query.max_cost}"
+        )
+    return problems
+
+
+def check_plans(session, queries=CANONICAL_QUERIES):
+    """
+    Explains every canonical query and returns {query name: [problems]}.
+    """
+    return {
+        query.name: plan_violations(query, explain(session, query.build(session)))
+        for query in queries
+    }
+
+
+def assert_plans(session, queries=CANONICAL_QUERIES):
+    seed_plan_dataset(session)
+    results = check_plans(session, queries)
+    failures = [
+        f"{name}: {problem}"
+        for name, problems in results.items()
+        for problem in problems
+    ]
+    assert not failures, "query plan regressions:\n  " + "\n  ".join(failures)
+
+
+def main():
+    with get_session() as session:
+        seed_plan_dataset(session)
+        results = check_plans(session)
+    for name, problems in results.items():
+        print(f"{'FAIL' if problems else 'ok':<5} {name}")
+        for problem in problems:
+            print(f"      {problem}")
+    return 1 if any(results.values()) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
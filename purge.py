@@ -0,0 +1,185 @@
+"""
+Bulk removal of rows together with everything that references them.
+
+Every foreign key in models.py is ondelete="RESTRICT", so removing a retired
+category means deleting its child categories, their products, the products'
+stock rows and promotion links first. purge() finds those dependencies in
+the metadata and deletes children before parents:
+
+    with get_session() as session:
+        deleted = purge(session, Category, Category.slug == "winter-2019")
+        # {"stock_management": 1200, "product_promotion_event": 300,
+        #  "product": 1200, "category": 4}
+
+Before anything is deleted, the whole dependency tree is walked with
+read-only queries: if any row in it is still referenced from an excluded
+table (order lines), the purge fails without having deleted anything.
+Rows are then deleted with set-based DELETE ... WHERE fk IN (...) statements on
+at most chunk_size parents at a time, each chunk in its own short
+transaction, so locks are held briefly and a large purge doesn't bloat one
+transaction. An interrupted purge can simply be run again.
+"""
+
+from sqlalchemy import delete, select
+
+from models import Base, OrderProduct
+
+# order history is never purged: a product or user that still has order
+# lines can't be deleted (the RESTRICT foreign key raises)
+DEFAULT_EXCLUDE = (OrderProduct.__table__,)
+
+
+def referencing_tables(table, metadata=Base.metadata):
+    """
+    Returns (child table, foreign key column) for every foreign key pointing
+    to `table`, including self references.
+    """
+    found = []
+    for child in metadata.sorted_tables:
+        for fk in child.foreign_keys:
+            if fk.column.table is table:
+                found.append((child, fk.parent))
+    return found
+
+
+def _primary_key(table):
+    columns = list(table.primary_key.columns)
+    return columns[0] if len(columns) == 1 else None
+
+
+class _Purge:
+    def __init__(self, session, exclude, chunk_size, progress):
+        self.session = session
+        self.exclude = set(exclude)
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.deleted = {}
+
+    def _child_ids(self, table, child, fk, ids, after=None):
+        # one page of the rows of `child` referencing these rows of `table`
+        child_pk = _primary_key(child)
+        where = [fk.in_(ids)]
+        if child is table:
+            # a root category references itself
+            where.append(child_pk.not_in(ids))
+        if after is not None:
+            where.append(child_pk > after)
+        return self.session.scalars(
+            select(child_pk).where(*where).order_by(child_pk).limit(self.chunk_size)
+        ).all()
+
+    def check_rows(self, table, ids):
+        """
+        Raises ValueError if any of these rows, or any row that would be
+        deleted with them, is referenced from an excluded table. Only reads,
+        so nothing has been deleted when it raises.
+        """
+        for child, fk in referencing_tables(table):
+            if child in self.exclude:
+                blocked = self.session.scalar(select(fk).where(fk.in_(ids)).limit(1))
+                if blocked is not None:
+                    self.session.rollback()
+                    raise ValueError(
+                        f"{table.name} {blocked} is still referenced from {child.name}"
+                    )
+                continue
+            if _primary_key(child) is None:
+                # association rows: nothing can reference them
+                continue
+            last_id = None
+            while True:
+                child_ids = self._child_ids(table, child, fk, ids, last_id)
+                if not child_ids:
+                    break
+                self.check_rows(child, child_ids)
+                last_id = child_ids[-1]
+
+    def delete_rows(self, table, ids):
+        """
+        Deletes the rows of `table` with these primary keys, after
+        everything that references them.
+        """
+        pk = _primary_key(table)
+        references = referencing_tables(table)
+        # check_rows() ran before the purge started, this only catches
+        # references added since then, before this chunk's stock rows etc. go
+        for child, fk in references:
+            if child not in self.exclude:
+                continue
+            blocked = self.session.scalar(select(fk).where(fk.in_(ids)).limit(1))
+            if blocked is not None:
+                self.session.rollback()
+                raise ValueError(
+                    f"{table.name} {blocked} is still referenced from {child.name}"
+                )
+        for child, fk in references:
+            if child in self.exclude:
+                continue
+            child_pk = _primary_key(child)
+            if child_pk is None:
+                # composite key (association rows): nothing references
+                # them, one statement for the whole parent chunk
+                self._delete(child, fk.in_(ids))
+                continue
+            while True:
+                child_ids = self._child_ids(table, child, fk, ids)
+                if not child_ids:
+                    break
+                self.delete_rows(child, child_ids)
+        self._delete(table, pk.in_(ids))
+
+    def _delete(self, table, where):
+        try:
+            count = self.session.execute(delete(table).where(where)).rowcount
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            print(f"Error: purging {table.name} failed: {e}")
+            raise
+        self.deleted[table.name] = self.deleted.get(table.name, 0) + count
+        if self.progress is not None:
+            self.progress(table.name, count, self.deleted)
+
+
+def purge(
+    session, model, *where, exclude=DEFAULT_EXCLUDE, chunk_size=1000, progress=None
+):
+    """
+    Deletes the rows of `model` matching `where`, and all rows referencing
+    them (recursively), children first. Tables in `exclude` are never
+    touched; rows referenced from them make the purge fail before anything
+    is deleted.
+
+    progress(table name, rows deleted by the last statement, totals) is called
+    after every chunk. Returns {table name: rows deleted}.
+    """
+    table = model.__table__
+    pk = _primary_key(table)
+    if pk is None:
+        raise ValueError(f"{table.name} has a composite primary key")
+
+    job = _Purge(session, exclude, chunk_size, progress)
+    last_id = None
+    while True:
+        stmt = select(pk).where(*where).order_by(pk).limit(chunk_size)
+        if last_id is not None:
+            stmt = stmt.where(pk > last_id)
+        ids = session.scalars(stmt).all()
+        if not ids:
+            break
+        job.check_rows(table, ids)
+        last_id = ids[-1]
+    session.rollback()
+
+    last_id = None
+    while True:
+        stmt = select(pk).where(*where).order_by(pk).limit(chunk_size)
+        if last_id is not None:
+            stmt = stmt.where(pk > last_id)
+        ids = session.scalars(stmt).all()
+        if not ids:
+            break
+        job.delete_rows(table, ids)
+        last_id = ids[-1]
+    session.commit()
+    return job.deleted
@@ -0,0 +1,224 @@
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import sqlalchemy
+from sqlalchemy import event
+
+from db import get_engine
+from sql_normalize import normalize_sql
+
+_SQLALCHEMY_DIR = os.path.dirname(sqlalchemy.__file__)
+
+
+class StatementStats:
+    __slots__ = (
+        "sql",
+        "calls",
+        "total_time",
+        "min_time",
+        "max_time",
+        "rows",
+        "samples",
+        "call_sites",
+    )
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.calls = 0
+        self.total_time = 0.0
+        self.min_time = math.inf
+        self.max_time = 0.0
+        self.rows = 0
+        # reservoir sample of the timings, for the p99
+        self.samples = []
+        self.call_sites = Counter()
+
+    def as_dict(self):
+        samples = sorted(self.samples)
+        p99 = samples[max(0, math.ceil(len(samples) * 0.99) - 1)] if samples else 0.0
+        return {
+            "calls": self.calls,
+            "total_ms": self.total_time * 1000,
+            "mean_ms": self.total_time * 1000 / self.calls if self.calls else 0.0,
+            "min_ms": self.min_time * 1000 if self.calls else 0.0,
+            "max_ms": self.max_time * 1000,
+            "p99_ms": p99 * 1000,
+            "rows": self.rows,
+            "call_sites": dict(self.call_sites.most_common()),
+        }
+
+
+class QueryStats:
+    """
+    pg_stat_statements for the application side: per normalized statement,
+    counts calls, total/mean/min/max/p99 time, rows and the code that runs it.
+
+        stats = QueryStats().install()
+        before = stats.snapshot()
+        ...
+        slowest = sorted(
+            QueryStats.diff(before, stats.snapshot()).items(),
+            key=lambda item: item[1]["total_ms"],
+            reverse=True,
+        )
+        stats.dump("query_stats.json")
+
+    Memory is bounded: at most max_statements statements are tracked (the
+    least recently executed one is evicted), reservoir_size timings per
+    statement for the p99 and max_call_sites call sites per statement.
+    Finding the call site means walking the stack, so it is only done for a
+    call_site_sample_rate fraction of executions; everything else is a
+    cached normalization, a dict lookup and a few additions under a lock,
+    cheap enough to leave on in every worker.
+    """
+
+    def __init__(
+        self,
+        engine=None,
+        max_statements=1000,
+        reservoir_size=256,
+        max_call_sites=5,
+        call_site_sample_rate=0.01,
+    ):
+        self.engine = engine if engine is not None else get_engine()
+        self.max_statements = max_statements
+        self.reservoir_size = reservoir_size
+        self.max_call_sites = max_call_sites
+        self.call_site_sample_rate = call_site_sample_rate
+
+        self.evicted = 0
+        self._statements = OrderedDict()
+        self._lock = threading.Lock()
+
+    def install(self):
+        event.listen(self.engine, "before_cursor_execute", self._before_execute)
+        event.listen(self.engine, "after_cursor_execute", self._after_execute)
+        return self
+
+    def remove(self):
+        event.remove(self.engine, "before_cursor_execute", self._before_execute)
+        event.remove(self.engine, "after_cursor_execute", self._after_execute)
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self.evicted = 0
+
+    def _before_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        if context is not None:
+            context._query_stats_start = time.perf_counter()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_query_stats_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        sql = normalize_sql(statement)
+        rows = max(cursor.rowcount, 0)
+        call_site = None
+        if random.random() < self.call_site_sample_rate:
+            call_site = _find_call_site()
+
+        with self._lock:
+            stats = self._statements.get(sql)
+            if stats is None:
+                stats = self._statements[sql] = StatementStats(sql)
+                if len(self._statements) > self.max_statements:
+                    self._statements.popitem(last=False)
+                    self.evicted += 1
+            else:
+                self._statements.move_to_end(sql)
+
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.rows += rows
+            if elapsed < stats.min_time:
+                stats.min_time = elapsed
+            if elapsed > stats.max_time:
+                stats.max_time = elapsed
+
+            if len(stats.samples) < self.reservoir_size:
+                stats.samples.append(elapsed)
+            else:
+                slot = random.randrange(stats.calls)
+                if slot < self.reservoir_size:
+                    stats.samples[slot] = elapsed
+
+            if call_site is not None:
+                sites = stats.call_sites
+                if call_site not in sites and len(sites) >= self.max_call_sites:
+                    # make room by dropping the least frequent site
+                    del sites[min(sites, key=sites.get)]
+                sites[call_site] += 1
+
+    def snapshot(self):
+        """
+        Returns {normalized sql: stats dict} for every tracked statement.
+        """
+        with self._lock:
+            return {sql: stats.as_dict() for sql, stats in self._statements.items()}
+
+    @staticmethod
+    def diff(before, after):
+        """
+        What happened between two snapshots: calls, time and rows are
+        subtracted, min/max/p99 are taken from `after` (percentiles
+        can't be subtracted).
+        """
+        result = {}
+        for sql, stats in after.items():
+            old = before.get(sql)
+            if old is None:
+                result[sql] = stats
+                continue
+            calls = stats["calls"] - old["calls"]
+            if calls <= 0:
+                continue
+            total = stats["total_ms"] - old["total_ms"]
+            result[sql] = dict(
+                stats,
+                calls=calls,
+                total_ms=total,
+                mean_ms=total / calls,
+                rows=stats["rows"] - old["rows"],
+            )
+        return result
+
+    def dump(self, path, snapshot=None):
+        """
+        Writes a snapshot to a JSON file, slowest statements (by total time) first.
+        """
+        snapshot = snapshot if snapshot is not None else self.snapshot()
+        ordered = sorted(
+            snapshot.items(), key=lambda item: item[1]["total_ms"], reverse=True
+        )
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "pid": os.getpid(),
+                    "captured_at": time.time(),
+                    "evicted": self.evicted,
+                    "statements": [{"sql": sql, **stats} for sql, stats in ordered],
+                },
+                file,
+                indent=2,
+            )
+
+
+def _find_call_site():
+    # the first frame outside SQLAlchemy and this module is the application code
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if not filename.startswith(_SQLALCHEMY_DIR) and filename != __file__:
+            return f"{filename}:{frame.f_lineno} {frame.f_code.co_name}"
+        frame = frame.f_back
+    return "<unknown>"
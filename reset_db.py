@@ -1,4 +1,4 @@
-from db import engine
+from db import get_engine
 from models import Base
 
 
@@ -9,6 +9,7 @@ def reset_database():
     # we didn't use session here because we are just dropping and creating tables
     # this is a schema level operation not a data level operation
     # because of that we use the engine directly
+    engine = get_engine()
     Base.metadata.drop_all(bind=engine)
     Base.metadata.create_all(bind=engine)
 
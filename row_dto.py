@@ -0,0 +1,87 @@
+from sqlalchemy import select
+
+# generated classes, keyed by (model, column names)
+_dto_classes = {}
+
+
+def _make_dto_class(name, fields):
+    # Same trick as dataclasses: generate a plain __init__ so building a row
+    # costs one function call and a few attribute stores, nothing else.
+    args = ", ".join(fields)
+    body = "".join(f"    self.{field} = {field}\n" for field in fields) or "    pass\n"
+    namespace = {}
+    exec(f"def __init__(self, {args}):\n{body}", namespace)
+
+    def __repr__(self):
+        values = ", ".join(f"{field}={getattr(self, field)!r}" for field in fields)
+        return f"{name}({values})"
+
+    def __eq__(self, other):
+        if other.__class__ is not self.__class__:
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in fields)
+
+    def _asdict(self):
+        return {field: getattr(self, field) for field in fields}
+
+    return type(
+        name,
+        (),
+        {
+            "__slots__": fields,
+            "__init__": namespace["__init__"],
+            "__repr__": __repr__,
+            "__eq__": __eq__,
+            "__hash__": None,
+            "_asdict": _asdict,
+            "_fields": fields,
+        },
+    )
+
+
+def _resolve_columns(model, columns):
+    if not columns:
+        return [getattr(model, attr.key) for attr in model.__mapper__.column_attrs]
+    return [getattr(model, c) if isinstance(c, str) else c for c in columns]
+
+
+def dto_class(model, *columns):
+    """
+    Returns the __slots__ row class for a model and a set of its columns,
+    e.g. dto_class(Product, "id", "name", "price") -> ProductRow.
+    Classes are generated once and cached.
+    """
+    columns = _resolve_columns(model, columns)
+    fields = tuple(column.key for column in columns)
+    key = (model, fields)
+    cls = _dto_classes.get(key)
+    if cls is None:
+        cls = _dto_classes[key] = _make_dto_class(f"{model.__name__}Row", fields)
+    return cls
+
+
+def select_rows(session, model, *columns, where=(), order_by=(), limit=None):
+    """
+    Read-only listing query: selects only the given columns of a model and
+    returns them as lightweight __slots__ objects instead of ORM instances.
+
+        products = select_rows(
+            session, Product, "id", "name", "slug", "price",
+            where=[Product.is_active.is_(True)],
+            order_by=[Product.name],
+            limit=50,
+        )
+        products[0].name
+
+    The rows don't go through the identity map and have no instrumented
+    attributes, so they can't be lazy loaded, modified or flushed back;
+    load the full Product when you need that.
+    """
+    columns = _resolve_columns(model, columns)
+    cls = dto_class(model, *columns)
+
+    stmt = select(*columns).where(*where).order_by(*order_by)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+
+    return [cls(*row) for row in session.execute(stmt)]
@@ -1,12 +1,99 @@
+import os
+import random
+import threading
+import time
+from collections import Counter
 from contextlib import contextmanager
+from contextvars import ContextVar
+
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import DBAPIError
 
 from db import SessionLocal
 
+# serialization_failure and deadlock_detected
+# both mean "nothing is wrong with your transaction, just run it again"
+RETRYABLE_SQLSTATES = {"40001", "40P01"}
+
+# The session of the get_session() block we are currently inside of.
+# Every thread starts with an empty ContextVar, so threads never see each
+# other's session. asyncio tasks are different: create_task() copies the
+# current context, so a task created inside a get_session() block shares
+# the creator's session (and its connection) while both run. Create tasks
+# that use the database outside of the block, or give them a fresh context:
+# create_task(coro, context=contextvars.Context()) on Python 3.11+.
+_current_session = ContextVar("current_session", default=None)
+
+
+# A forked child continues in a copy of the forking thread's context, so a
+# fork inside a get_session() block (ProcessPoolExecutor.submit() with the
+# "fork" start method) would hand the parent's session and connection to the
+# child. The child must open its own.
+def _forget_session_in_child():
+    _current_session.set(None)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_session_in_child)
+
+
+def _level_name(isolation_level):
+    # "repeatable_read" and "REPEATABLE READ" are the same level
+    return isolation_level.replace("_", " ").upper()
+
+
+def _set_isolation_level(session, isolation_level):
+    bind = session.get_bind()
+    if isinstance(bind, Connection) and bind.in_transaction():
+        # The session joins a transaction that is already running
+        # (transactional_test()); its isolation level was fixed when it
+        # began and can't be changed from here, see transactional_test().
+        return
+    # applied to the connection the session checks out for this transaction
+    session.connection(execution_options={"isolation_level": isolation_level})
+
 
 @contextmanager
-def get_session():
+def get_session(isolation_level=None):
+    """
+    Opens a session, commits it at the end of the block and rolls it back on error.
+
+    Nested calls reuse the session of the outermost block, so helpers can call
+    get_session() themselves without opening another session and connection:
+
+        def add_stock(product):
+            with get_session() as session:  # same session as below
+                session.add(StockManagement(product=product, ...))
+
+        with get_session() as session:
+            product = Product(...)
+            session.add(product)
+            add_stock(product)
+
+    Only the outermost block commits, rolls back and closes the session;
+    isolation_level is therefore only applied by the outermost block too,
+    and a nested block asking for a different level raises ValueError
+    instead of silently running at the outer one.
+    Processes forked inside the block start without a session, asyncio tasks
+    created inside it share it (see _current_session).
+    """
+    session = _current_session.get()
+    if session is not None:
+        if isolation_level is not None:
+            current = session.connection().get_isolation_level()
+            if _level_name(isolation_level) != _level_name(current):
+                raise ValueError(
+                    f"get_session(isolation_level={isolation_level!r}) inside a "
+                    f"block running at {current}"
+                )
+        yield session
+        return
+
     session = SessionLocal()
+    token = _current_session.set(session)
     try:
+        if isolation_level is not None:
+            _set_isolation_level(session, isolation_level)
         yield session
         session.commit()
     except Exception as e:
@@ -14,4 +101,131 @@ def get_session():
         print(f"Error: {e}")
         raise
     finally:
+        _current_session.reset(token)
         session.close()
+
+
+def current_session():
+    """
+    Returns the session of the enclosing get_session() block.
+    """
+    session = _current_session.get()
+    if session is None:
+        raise RuntimeError("current_session() called outside of get_session()")
+    return session
+
+
+class RetryMetrics:
+    """
+    Counters for run_in_transaction(), shared by all threads of the process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.transactions = 0
+            self.attempts = 0
+            self.retries = 0
+            self.exhausted = 0
+            self.retries_by_sqlstate = Counter()
+
+    def record_attempt(self):
+        with self._lock:
+            self.attempts += 1
+
+    def record_retry(self, sqlstate):
+        with self._lock:
+            self.retries += 1
+            self.retries_by_sqlstate[sqlstate] += 1
+
+    def record_done(self, exhausted=False):
+        with self._lock:
+            self.transactions += 1
+            if exhausted:
+                self.exhausted += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "transactions": self.transactions,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "exhausted": self.exhausted,
+                "retries_by_sqlstate": dict(self.retries_by_sqlstate),
+            }
+
+
+retry_metrics = RetryMetrics()
+
+
+def get_sqlstate(error):
+    """
+    Returns the SQLSTATE of a database error, or None.
+    psycopg2 exposes it as pgcode, psycopg 3 as sqlstate.
+    """
+    if not isinstance(error, DBAPIError):
+        return None
+    orig = error.orig
+    return getattr(orig, "pgcode", None) or getattr(orig, "sqlstate", None)
+
+
+def run_in_transaction(
+    work,
+    isolation_level=None,
+    max_attempts=5,
+    base_delay=0.05,
+    max_delay=2.0,
+):
+    """
+    Runs work(session) in its own transaction and commits it.
+    If the transaction fails with a serialization failure or a deadlock
+    the whole unit of work is run again on a fresh session, waiting a
+    jittered exponential backoff between attempts.
+
+    Example:
+
+        def reserve(session):
+            stock = session.get(StockManagement, stock_id)
+            stock.quantity -= 1
+
+        run_in_transaction(reserve, isolation_level="SERIALIZABLE")
+
+    work() may run more than once, so it must not have side effects outside
+    the database (sending emails, charging cards, ...).
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        retry_metrics.record_attempt()
+        session = SessionLocal()
+        # get_session() calls made by work() join this attempt's transaction
+        token = _current_session.set(session)
+        try:
+            if isolation_level is not None:
+                _set_isolation_level(session, isolation_level)
+            result = work(session)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            sqlstate = get_sqlstate(e)
+            if sqlstate not in RETRYABLE_SQLSTATES:
+                retry_metrics.record_done()
+                raise
+            if attempt >= max_attempts:
+                retry_metrics.record_done(exhausted=True)
+                raise
+            retry_metrics.record_retry(sqlstate)
+        else:
+            retry_metrics.record_done()
+            return result
+        finally:
+            _current_session.reset(token)
+            session.close()
+
+        # "full jitter": sleep a random time up to the exponential cap,
+        # so competing transactions don't retry in lockstep
+        delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+        time.sleep(random.uniform(0, delay))
@@ -0,0 +1,32 @@
+import re
+from functools import lru_cache
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+# %(name)s and %s (psycopg2), ? (sqlite), :name, $1
+_PARAMETER = re.compile(r"%\(\w+\)s|%s|\?|(?<![:\w]):[A-Za-z_]\w*|\$\d+")
+# IN (?, ?, ?) with any number of values
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+# multi-row VALUES (?, ?), (?, ?) from executemany/insertmanyvalues
+_VALUES = re.compile(r"VALUES\s*\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=4096)
+def normalize_sql(statement):
+    """
+    Reduces a statement to its shape, so all executions of the same query
+    are grouped together whatever their parameters:
+
+        SELECT * FROM product WHERE id IN (%(id_1_1)s, %(id_1_2)s) AND price > 10
+        -> SELECT * FROM product WHERE id IN (...) AND price > ?
+
+    SQLAlchemy caches compiled statements, so the same strings come back over
+    and over; the lru_cache makes normalizing them nearly free.
+    """
+    statement = _STRING.sub("?", statement)
+    statement = _PARAMETER.sub("?", statement)
+    statement = _NUMBER.sub("?", statement)
+    statement = _LIST.sub("(...)", statement)
+    statement = _VALUES.sub("VALUES (...)", statement)
+    return _WHITESPACE.sub(" ", statement).strip()
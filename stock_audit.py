@@ -0,0 +1,135 @@
+"""
+Re-checks stock rows that haven't been checked for a while, with any number
+of workers (threads, processes or machines) and without two of them ever
+checking the same row.
+
+stock_management is used as a job queue: a worker claims the stalest rows
+with SELECT ... ORDER BY last_checked_at LIMIT n FOR UPDATE SKIP LOCKED
+(served by ix_stock_management_last_checked_at), checks them, and stamps
+last_checked_at on the whole batch with one UPDATE before committing.
+Rows claimed by another worker are locked, so they are skipped instead of
+waited for.
+
+check(row) returns the counted quantity. row["quantity"] is what the
+inventory reports (inventory.available_quantities(): snapshot, shards and
+ledger), and a difference is recorded as a stock movement, never written
+over the snapshot:
+
+    def count_shelf(row):
+        # row: {"id", "product_id", "quantity", "last_checked_at"}
+        return warehouse_api.count(row["product_id"])
+
+    run_stale_checks(count_shelf, older_than=timedelta(days=1), workers=8)
+"""
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+from batch_jobs import _init_worker
+from inventory import available_quantities, record_movements
+from models import StockManagement
+from session import get_session
+
+
+def claim_stale(session, cutoff, batch_size=100):
+    """
+    Locks up to batch_size rows last checked before cutoff, stalest first,
+    skipping rows other workers hold. Returns them as dicts with the
+    product's available quantity; they stay locked until the session's
+    transaction ends.
+    """
+    rows = session.execute(
+        select(
+            StockManagement.id,
+            StockManagement.product_id,
+            StockManagement.last_checked_at,
+        )
+        .where(StockManagement.last_checked_at < cutoff)
+        .order_by(StockManagement.last_checked_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+    rows = [row._asdict() for row in rows]
+    # the snapshot alone misses sharded stock and uncompacted movements
+    quantities = available_quantities(session, [row["product_id"] for row in rows])
+    for row in rows:
+        row["quantity"] = quantities[row["product_id"]]
+    return rows
+
+
+def complete(session, rows, corrections, checked_at=None):
+    """
+    Stamps last_checked_at on all claimed rows with one UPDATE and records
+    the corrections ({product id: delta}) as stock movements with one
+    executemany. Movements recorded by sales in the meantime are kept.
+    """
+    checked_at = checked_at or datetime.now(timezone.utc)
+    session.execute(
+        update(StockManagement)
+        .where(StockManagement.id.in_([row["id"] for row in rows]))
+        .values(last_checked_at=checked_at)
+        .execution_options(synchronize_session=False)
+    )
+    record_movements(
+        session,
+        [
+            {"product_id": product_id, "delta": delta, "reason": "stock audit"}
+            for product_id, delta in corrections.items()
+        ],
+    )
+
+
+def _drain(check, cutoff, batch_size):
+    # one worker: claim, check and complete batches until no stale row is left
+    checked = corrected = 0
+    while True:
+        with get_session() as session:
+            rows = claim_stale(session, cutoff, batch_size)
+            if not rows:
+                return checked, corrected
+            corrections = {}
+            for row in rows:
+                counted = check(row)
+                if counted is not None and counted != row["quantity"]:
+                    corrections[row["product_id"]] = counted - row["quantity"]
+            complete(session, rows, corrections)
+        checked += len(rows)
+        corrected += len(corrections)
+
+
+def run_stale_checks(
+    check,
+    older_than=timedelta(hours=24),
+    batch_size=100,
+    workers=4,
+    processes=False,
+):
+    """
+    Runs check(row) on every stock row not checked for older_than, in
+    `workers` threads (or processes with processes=True, check must then be
+    a module-level function). check returns the counted quantity, or None
+    when the product couldn't be counted.
+
+    Each batch is one transaction: its rows stay locked while they are
+    checked, so keep batch_size small when check is slow. If check raises,
+    the batch is rolled back and picked up again by the next run.
+    Returns {"checked": rows checked, "corrected": rows corrected}.
+    """
+    # fixed at the start, so rows checked during this run aren't claimed again
+    cutoff = datetime.now(timezone.utc) - older_than
+    if processes:
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+    else:
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    with pool:
+        futures = [
+            pool.submit(_drain, check, cutoff, batch_size) for _ in range(workers)
+        ]
+        results = [future.result() for future in futures]
+    return {
+        "checked": sum(checked for checked, _ in results),
+        "corrected": sum(corrected for _, corrected in results),
+    }
@@ -0,0 +1,209 @@
+"""
+Sharded stock for flash-sale products.
+
+A normal product keeps its stock in its single stock_management row, and
+every sale does UPDATE stock_management ... WHERE product_id = X: all buyers
+of a hot product queue behind that one row lock until each transaction
+commits. Sharding spreads the stock over `slots` stock_shard rows; a sale
+takes it from a random slot that nobody else has locked (SKIP LOCKED), so up
+to `slots` buyers proceed at the same time.
+
+    enable_sharding(session, product_id, slots=16)    # before the sale
+    ...
+    if not decrement_stock(session, product_id):       # at checkout
+        raise SoldOut()
+    ...
+    disable_sharding(session, product_id)              # afterwards
+
+decrement_stock() works the same for sharded and normal products, and
+inventory.available_quantity() sums the shards, so callers don't need to know.
+"""
+
+import random
+import time
+
+from sqlalchemy import delete, func, insert, select, update
+
+from models import StockManagement, StockShard
+
+# how long decrement_stock() waits before looking for a free slot again, when
+# every slot with enough stock is locked by another buyer
+RETRY_DELAY = 0.002
+
+
+def is_sharded(session, product_id):
+    return (
+        session.scalar(
+            select(StockShard.slot).where(StockShard.product_id == product_id).limit(1)
+        )
+        is not None
+    )
+
+
+def _lock_stock(session, product_id):
+    # the stock_management row is locked first and the shards after it, in
+    # slot order, by everything that touches several rows: no deadlocks
+    stock = session.execute(
+        select(StockManagement.id, StockManagement.quantity)
+        .where(StockManagement.product_id == product_id)
+        .with_for_update()
+    ).first()
+    if stock is None:
+        raise ValueError(f"product {product_id} has no stock row")
+    return stock
+
+
+def _lock_shards(session, product_id):
+    return session.execute(
+        select(StockShard.slot, StockShard.quantity)
+        .where(StockShard.product_id == product_id)
+        .order_by(StockShard.slot)
+        .with_for_update()
+    ).all()
+
+
+def enable_sharding(session, product_id, slots=8):
+    """
+    Moves the product's stock from stock_management into `slots` evenly
+    filled stock_shard rows. Commits.
+    """
+    if slots < 1:
+        raise ValueError("slots must be at least 1")
+    stock = _lock_stock(session, product_id)
+    if is_sharded(session, product_id):
+        raise ValueError(f"product {product_id} is already sharded")
+
+    share, extra = divmod(stock.quantity, slots)
+    session.execute(
+        insert(StockShard),
+        [
+            {
+                "product_id": product_id,
+                "slot": slot,
+                "quantity": share + (1 if slot < extra else 0),
+            }
+            for slot in range(slots)
+        ],
+    )
+    session.execute(
+        update(StockManagement).where(StockManagement.id == stock.id).values(quantity=0)
+    )
+    session.commit()
+
+
+def disable_sharding(session, product_id):
+    """
+    Moves the stock left in the shards back into stock_management and removes
+    the shards. Commits. Returns the quantity moved back.
+    """
+    stock = _lock_stock(session, product_id)
+    total = sum(quantity for _, quantity in _lock_shards(session, product_id))
+    session.execute(delete(StockShard).where(StockShard.product_id == product_id))
+    session.execute(
+        update(StockManagement)
+        .where(StockManagement.id == stock.id)
+        .values(quantity=StockManagement.quantity + total)
+    )
+    session.commit()
+    return total
+
+
+def _free_slot(product_id, minimum=0):
+    # one random unlocked slot, evaluated once as an InitPlan by PostgreSQL
+    return (
+        select(StockShard.slot)
+        .where(StockShard.product_id == product_id, StockShard.quantity >= minimum)
+        .order_by(func.random())
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .scalar_subquery()
+    )
+
+
+def decrement_stock(session, product_id, quantity=1):
+    """
+    Takes `quantity` items of a product's stock. Returns False (and changes
+    nothing) when there aren't enough. Doesn't commit: the slot stays locked
+    until the caller's transaction ends.
+
+    Tries, in order: a random unlocked shard with enough stock, and the
+    stock_management row (all of the stock of a normal product). When all
+    shards with enough stock are merely locked by other buyers it tries again
+    shortly, and only when no single shard has enough left are all of them
+    locked together, to take the last items from several slots.
+    """
+    while True:
+        taken = session.execute(
+            update(StockShard)
+            .where(
+                StockShard.product_id == product_id,
+                StockShard.slot == _free_slot(product_id, quantity),
+            )
+            .values(quantity=StockShard.quantity - quantity)
+            .returning(StockShard.slot)
+        ).first()
+        if taken is not None:
+            return True
+
+        taken = session.execute(
+            update(StockManagement)
+            .where(
+                StockManagement.product_id == product_id,
+                StockManagement.quantity >= quantity,
+            )
+            .values(quantity=StockManagement.quantity - quantity)
+            .returning(StockManagement.id)
+        ).first()
+        if taken is not None:
+            return True
+
+        # a plain read of the committed shards, it doesn't wait for locks
+        total, largest = session.execute(
+            select(func.sum(StockShard.quantity), func.max(StockShard.quantity)).where(
+                StockShard.product_id == product_id
+            )
+        ).one()
+        if total is None or total < quantity:
+            return False
+        if largest < quantity:
+            break
+        time.sleep(random.uniform(0, RETRY_DELAY))
+
+    shards = _lock_shards(session, product_id)
+    if sum(available for _, available in shards) < quantity:
+        return False
+    remaining = quantity
+    for slot, available in shards:
+        step = min(available, remaining)
+        if step:
+            session.execute(
+                update(StockShard)
+                .where(StockShard.product_id == product_id, StockShard.slot == slot)
+                .values(quantity=StockShard.quantity - step)
+            )
+            remaining -= step
+        if not remaining:
+            break
+    return True
+
+
+def increment_stock(session, product_id, quantity):
+    """
+    Adds stock (restocking, cancelled orders) to a random unlocked shard, or
+    to stock_management for a normal product. Doesn't commit.
+    """
+    added = session.execute(
+        update(StockShard)
+        .where(
+            StockShard.product_id == product_id,
+            StockShard.slot == _free_slot(product_id),
+        )
+        .values(quantity=StockShard.quantity + quantity)
+        .returning(StockShard.slot)
+    ).first()
+    if added is None:
+        session.execute(
+            update(StockManagement)
+            .where(StockManagement.product_id == product_id)
+            .values(quantity=StockManagement.quantity + quantity)
+        )
@@ -0,0 +1,38 @@
+"""
+Runs the query-plan regression checks of plan_checks.py.
+
+The checks seed and commit a sizeable dataset, so they run in a throwaway
+database cloned by db_provisioning (inventory_test_main, ...), never in the
+database of DATABASE_URL itself. Skipped when that server isn't a reachable
+PostgreSQL server or the clone can't be made.
+"""
+
+import pytest
+from sqlalchemy.exc import DBAPIError
+
+import db
+from db_provisioning import provision_worker_database
+from plan_checks import assert_plans
+from session import get_session
+
+
+@pytest.fixture(scope="module")
+def plan_database():
+    original_url = db.get_engine().url
+    if original_url.get_backend_name() != "postgresql":
+        pytest.skip(
+            f"plan checks need PostgreSQL, not {original_url.get_backend_name()}"
+        )
+    try:
+        url = provision_worker_database()
+    except DBAPIError as e:
+        pytest.skip(f"can't provision a test database: {e.orig}")
+    try:
+        yield url
+    finally:
+        db.configure_engine(original_url)
+
+
+def test_query_plans(plan_database):
+    with get_session() as session:
+        assert_plans(session)
@@ -0,0 +1,322 @@
+import json
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from db import SessionLocal, get_engine
+from sql_normalize import normalize_sql
+
+# the innermost open span of the current thread / asyncio task
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "tracer",
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start",
+        "end",
+        "attributes",
+        "_token",
+    )
+
+    def __init__(self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(64):016x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.time()
+        self.end = None
+        self.attributes = attributes
+        self._token = None
+
+    @property
+    def duration_ms(self):
+        return (self.end - self.start) * 1000 if self.end is not None else None
+
+    def finish(self, **attributes):
+        if self.end is not None:
+            return
+        self.end = time.time()
+        self.attributes.update(attributes)
+        if self._token is not None:
+            try:
+                _current_span.reset(self._token)
+            except ValueError:
+                # finished from another context than it was started in
+                pass
+        self.tracer.export(self)
+
+    def as_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """
+    Minimal span tracer. Spans nest through a ContextVar, so they follow
+    threads and asyncio tasks like get_session() does.
+
+        tracer = Tracer([JsonLinesExporter("spans.jsonl")])
+        with tracer.span("checkout request", user_id=user.id):
+            ...
+    """
+
+    def __init__(self, exporters=()):
+        self.exporters = list(exporters)
+
+    def current(self):
+        return _current_span.get()
+
+    def start_span(self, name, activate=True, parent=None, **attributes):
+        """
+        Starts a span as a child of `parent`, by default of the current one.
+        With activate=True it becomes the current span until it is finished.
+        """
+        if parent is None:
+            parent = _current_span.get()
+        span = Span(self, name, parent, attributes)
+        if activate:
+            span._token = _current_span.set(span)
+        return span
+
+    def span(self, name, **attributes):
+        return _SpanContext(self, name, attributes)
+
+    def export(self, span):
+        for exporter in self.exporters:
+            exporter.export(span)
+
+
+class _SpanContext:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        self.span = self.tracer.start_span(self.name, **self.attributes)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.span.finish(error=repr(exc))
+        else:
+            self.span.finish()
+
+
+class InMemoryCollector:
+    """
+    Keeps finished spans in a list, for tests.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def by_name(self, name):
+        return [span for span in self.spans if span.name == name]
+
+    def children(self, parent):
+        return [span for span in self.spans if span.parent_id == parent.span_id]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+class JsonLinesExporter:
+    """
+    Appends one JSON object per finished span to a local file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span):
+        line = json.dumps(span.as_dict(), default=str) + "\n"
+        with self._lock, open(self.path, "a") as file:
+            file.write(line)
+
+
+def instrument(tracer, engine=None, session_factory=SessionLocal):
+    """
+    Emits nested spans for the phases of every session made by session_factory:
+
+        session.transaction          begin .. commit/rollback/close
+          session.execute            an ORM query
+            pool.checkout            waiting for a pooled connection
+            session.autoflush        the flush it triggered
+              db.execute             each SQL statement
+          session.commit
+            session.flush
+              db.execute
+
+    The time of a flush span not covered by its db.execute children is
+    spent in the unit of work itself (sorting, SQL generation).
+    """
+    engine = engine if engine is not None else get_engine()
+
+    # The transaction span is never the current span: it outlives the calls
+    # that start and end it, so resetting the ContextVar when it ends would
+    # bring back whatever was current back then. The session's phases are
+    # parented to it explicitly instead, through session.info.
+    def _start_phase(session, name, **attributes):
+        phases = session.info.setdefault("trace_phases", [])
+        current = tracer.current()
+        if current is not None and current in phases:
+            parent = current
+        else:
+            parent = session.info.get("trace_transaction", current)
+        span = tracer.start_span(name, parent=parent, **attributes)
+        phases.append(span)
+        return span
+
+    def _finish_phase(session, span, **attributes):
+        phases = session.info.get("trace_phases", [])
+        if span in phases:
+            phases.remove(span)
+        span.finish(**attributes)
+
+    @event.listens_for(session_factory, "after_transaction_create")
+    def _transaction_created(session, transaction):
+        # only the outermost transaction, not SAVEPOINTs
+        if transaction.parent is not None:
+            return
+        phases = session.info.get("trace_phases")
+        if not phases:
+            session.info["trace_transaction"] = tracer.start_span(
+                "session.transaction", activate=False
+            )
+            return
+        # autobegin runs inside the first query (or flush, or commit): put
+        # the transaction between that phase and its parent
+        outer = phases[0]
+        span = tracer.start_span("session.transaction", activate=False)
+        span.trace_id, span.parent_id = outer.trace_id, outer.parent_id
+        outer.parent_id = span.span_id
+        session.info["trace_transaction"] = span
+
+    @event.listens_for(session_factory, "after_rollback")
+    def _rolled_back(session):
+        # phases interrupted by an error never got their "after" event; the
+        # rollback happens while they are still on the stack, innermost first
+        for key in ("trace_flush", "trace_commit"):
+            span = session.info.pop(key, None)
+            if span is not None:
+                _finish_phase(session, span, error="interrupted")
+
+    @event.listens_for(session_factory, "after_transaction_end")
+    def _transaction_ended(session, transaction):
+        if transaction.parent is not None:
+            return
+        span = session.info.pop("trace_transaction", None)
+        if span is not None:
+            span.finish()
+
+    @event.listens_for(session_factory, "do_orm_execute")
+    def _orm_execute(orm_execute_state):
+        # runs the statement ourselves, so the span covers the autoflush too
+        session = orm_execute_state.session
+        span = _start_phase(
+            session, "session.execute", kind=orm_execute_state.statement.__visit_name__
+        )
+        try:
+            result = orm_execute_state.invoke_statement()
+        except Exception as e:
+            _finish_phase(session, span, error=repr(e))
+            raise
+        _finish_phase(session, span)
+        return result
+
+    @event.listens_for(session_factory, "before_flush")
+    def _before_flush(session, flush_context, instances):
+        current = tracer.current()
+        name = "session.flush"
+        if current is not None and current.name == "session.execute":
+            name = "session.autoflush"
+        session.info["trace_flush"] = _start_phase(
+            session,
+            name,
+            new=len(session.new),
+            dirty=len(session.dirty),
+            deleted=len(session.deleted),
+        )
+
+    @event.listens_for(session_factory, "after_flush_postexec")
+    def _after_flush(session, flush_context):
+        span = session.info.pop("trace_flush", None)
+        if span is not None:
+            _finish_phase(session, span)
+
+    @event.listens_for(session_factory, "before_commit")
+    def _before_commit(session):
+        session.info["trace_commit"] = _start_phase(session, "session.commit")
+
+    @event.listens_for(session_factory, "after_commit")
+    def _after_commit(session):
+        span = session.info.pop("trace_commit", None)
+        if span is not None:
+            _finish_phase(session, span)
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._trace_span = tracer.start_span(
+                "db.execute", sql=normalize_sql(statement), executemany=executemany
+            )
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_execute(conn, cursor, statement, parameters, context, executemany):
+        span = getattr(context, "_trace_span", None)
+        if span is not None:
+            span.finish(rows=cursor.rowcount)
+
+    @event.listens_for(engine, "handle_error")
+    def _handle_error(exception_context):
+        span = getattr(exception_context.execution_context, "_trace_span", None)
+        if span is not None:
+            span.finish(error=repr(exception_context.original_exception))
+
+    # The pool has no "before checkout" event, only "checkout" once a
+    # connection was handed out, so the pool's connect() is wrapped to time
+    # the wait. engine.dispose() replaces the pool, wrap the new one too.
+    def _wrap_pool(pool):
+        connect = pool.connect
+
+        def traced_connect():
+            with tracer.span("pool.checkout"):
+                return connect()
+
+        pool.connect = traced_connect
+
+    _wrap_pool(engine.pool)
+
+    @event.listens_for(engine, "engine_disposed")
+    def _disposed(engine_):
+        _wrap_pool(engine_.pool)
+
+    @event.listens_for(engine, "checkout")
+    def _checkout(dbapi_connection, connection_record, connection_proxy):
+        current = tracer.current()
+        if current is not None and current.name == "pool.checkout":
+            current.attributes["pool"] = engine.pool.status()
@@ -0,0 +1,55 @@
+"""
+Tests that roll back instead of resetting the database.
+
+The test runs inside one outer transaction on one connection. Every
+get_session() (and every SessionLocal()) made during the test joins that
+transaction through a SAVEPOINT: session.commit() releases the savepoint and
+session.rollback() rolls back to it, so the code under test behaves as usual,
+but nothing is ever really committed. At the end of the test the outer
+transaction is rolled back and the database is back where it started.
+
+In a pytest conftest.py:
+
+    @pytest.fixture(autouse=True)
+    def db_transaction():
+        with transactional_test() as connection:
+            yield connection
+
+Combine with db_provisioning.provision_worker_database() for the schema.
+
+The isolation level can't change inside a running transaction, so
+get_session(isolation_level=...) and run_in_transaction(isolation_level=...)
+keep the level of the outer transaction instead. Tests of code that needs a
+particular level pass it here:
+
+    with transactional_test(isolation_level="SERIALIZABLE") as connection:
+        ...
+
+The connection is shared by all sessions of the test, so the code under test
+must not use it from several threads at once.
+"""
+
+from contextlib import contextmanager
+
+import db
+
+
+@contextmanager
+def transactional_test(engine=None, isolation_level=None):
+    engine = engine or db.get_engine()
+    connection = engine.connect()
+    if isolation_level is not None:
+        connection.execution_options(isolation_level=isolation_level)
+    transaction = connection.begin()
+
+    # bind every new session to our connection; "create_savepoint" makes the
+    # session run its own transaction as a SAVEPOINT inside ours
+    original_kw = dict(db.SessionLocal.kw)
+    db.SessionLocal.configure(bind=connection, join_transaction_mode="create_savepoint")
+    try:
+        yield connection
+    finally:
+        db.SessionLocal.kw.clear()
+        db.SessionLocal.kw.update(original_kw)
+        transaction.rollback()
+        connection.close()
@@ -0,0 +1,152 @@
+from collections import namedtuple
+
+from sqlalchemy import Boolean, literal_column, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import PRODUCT_HASH_FIELDS, Category, Product, User, product_content_hash
+
+# natural key (a unique column) of the models sync jobs upsert
+NATURAL_KEYS = {
+    Product: "slug",
+    Category: "slug",
+    User: "email",
+}
+
+UpsertResult = namedtuple("UpsertResult", ["key", "id", "inserted"])
+
+
+def _lowercase_category(row):
+    # same rule as lowercase_category_fields / the category trigger; done here
+    # too so "Shoes" and "shoes" in one batch are recognised as the same row
+    for field in ("name", "slug"):
+        if row.get(field):
+            row[field] = row[field].lower()
+    return row
+
+
+def _hash_product(row):
+    # what update_content_hash does for ORM writes; missing fields count as
+    # their column default, which is right for inserts, see upsert() for updates
+    if "content_hash" not in row:
+        row["content_hash"] = product_content_hash(row)
+    return row
+
+
+NORMALIZERS = {
+    Category: _lowercase_category,
+    Product: _hash_product,
+}
+
+# models with a stored content hash, and the columns it covers
+CONTENT_HASHES = {
+    Product: PRODUCT_HASH_FIELDS,
+}
+
+
+def _insert(dialect_name):
+    if dialect_name == "postgresql":
+        return postgresql.insert
+    if dialect_name == "sqlite":
+        return sqlite.insert
+    raise ValueError(f"upsert is not supported on {dialect_name}")
+
+
+def upsert(session, model, rows, key=None, update_columns=None, batch_size=500):
+    """
+    Inserts or updates rows (dicts of column values) by their natural key,
+    with one INSERT ... ON CONFLICT (key) DO UPDATE ... RETURNING per batch
+    instead of a SELECT and an INSERT or UPDATE per row.
+
+        results = upsert(session, Product, feed_rows, update_columns=["price"])
+        created = sum(result.inserted for result in results)
+
+    update_columns are the columns overwritten on existing rows, by default
+    every column given except the key. With an empty list existing rows are
+    left as they are (only their ids are returned). Columns with an onupdate
+    (Product.updated_at, ...) are refreshed on every update, as the ORM does,
+    and Product.content_hash is kept in step with the written values.
+    All rows must have the same columns. A row appearing twice in the input
+    is written once, with the last values.
+
+    Returns one UpsertResult(key, id, inserted) per distinct key, in input
+    order. Doesn't commit. Objects of the model already loaded in the session
+    are not refreshed.
+    """
+    key = key or NATURAL_KEYS[model]
+    table = model.__table__
+    key_column = table.c[key]
+    normalize = NORMALIZERS.get(model)
+    dialect_name = session.get_bind().dialect.name
+    insert = _insert(dialect_name)
+
+    unique = {}
+    columns = None
+    hash_given = False
+    for row in rows:
+        row = dict(row)
+        hash_given = hash_given or "content_hash" in row
+        if normalize is not None:
+            row = normalize(row)
+        if columns is None:
+            columns = set(row)
+        elif set(row) != columns:
+            raise ValueError(f"all rows must have the columns {sorted(columns)}")
+        # last one wins, but keep the position of the first
+        unique[row[key]] = row
+    if not unique:
+        return []
+
+    if update_columns is None:
+        update_columns = [name for name in columns if name != key]
+    hashed = CONTENT_HASHES.get(model)
+    if hashed is not None and not hash_given:
+        # The computed hash describes an updated row only if every hashed
+        # column is overwritten. Otherwise leave the hash alone: the
+        # product_content_hash_trigger clears it if a hashed column changed.
+        update_columns = [name for name in update_columns if name != "content_hash"]
+        if set(hashed) <= set(update_columns):
+            update_columns.append("content_hash")
+    onupdate = {
+        column.name: column.onupdate.arg
+        for column in table.columns
+        if column.onupdate is not None and column.onupdate.is_clause_element
+    }
+
+    results = {}
+    items = list(unique.values())
+    for start in range(0, len(items), batch_size):
+        batch = items[start : start + batch_size]
+        stmt = insert(table).values(batch)
+        set_ = {name: stmt.excluded[name] for name in update_columns}
+        if set_:
+            set_.update(
+                (name, value) for name, value in onupdate.items() if name not in set_
+            )
+        else:
+            # a no-op update, because DO NOTHING would not return the row
+            set_ = {key: stmt.excluded[key]}
+        stmt = stmt.on_conflict_do_update(index_elements=[key_column], set_=set_)
+
+        if dialect_name == "postgresql":
+            # xmax is 0 on a freshly inserted row version, and the id of the
+            # locking transaction on one written by ON CONFLICT DO UPDATE
+            inserted = literal_column("(xmax = 0)", Boolean)
+            stmt = stmt.returning(key_column, table.c.id, inserted.label("inserted"))
+            for row_key, row_id, was_inserted in session.execute(stmt):
+                results[row_key] = UpsertResult(row_key, row_id, was_inserted)
+        else:
+            # SQLite has a single writer, so checking beforehand is exact
+            existing = set(
+                session.scalars(
+                    select(key_column).where(
+                        key_column.in_([row[key] for row in batch])
+                    )
+                )
+            )
+            stmt = stmt.returning(key_column, table.c.id)
+            for row_key, row_id in session.execute(stmt):
+                results[row_key] = UpsertResult(
+                    row_key, row_id, row_key not in existing
+                )
+
+    return [results[row_key] for row_key in unique]